@@ -166,6 +166,14 @@ keystone.token_auth
     :py:class:`keystoneclient.session.Session`. This plugin will load the
     authentication data provided to auth_token middleware.
 
+keystone.service_catalog
+    Only set when the ``lazy_service_catalog`` option is enabled, in place of
+    HTTP_X_SERVICE_CATALOG. The service catalog of the user token, in the V2
+    catalog format, rendered when first used and then kept with the cached
+    token: ``str()`` of it gives the JSON otherwise found in
+    HTTP_X_SERVICE_CATALOG and its ``data`` attribute a decoded copy of the
+    catalog for this request.
+
 
 Configuration
 -------------
@@ -199,8 +207,19 @@ where the Swift cache object is stored.
 
 """
 
+import atexit
+import calendar
+import collections
 import datetime
 import logging
+import os
+import random
+import signal
+import sys
+import tempfile
+import threading
+import time
+import weakref
 
 from keystoneclient import access
 from keystoneclient import adapter
@@ -212,14 +231,18 @@ from keystoneclient import session
 from oslo_config import cfg
 from oslo_serialization import jsonutils
 import pkg_resources
+import requests
 import six
+from six.moves import urllib
 import webob.dec
 
 from keystonemiddleware.auth_token import _auth
 from keystonemiddleware.auth_token import _base
 from keystonemiddleware.auth_token import _cache
+from keystonemiddleware.auth_token import _cms
 from keystonemiddleware.auth_token import _exceptions as exc
 from keystonemiddleware.auth_token import _identity
+from keystonemiddleware.auth_token import _memcache_crypt
 from keystonemiddleware.auth_token import _request
 from keystonemiddleware.auth_token import _revocations
 from keystonemiddleware.auth_token import _signing_dir
@@ -260,6 +283,16 @@ _OPTS = [
                default=3,
                help='How many times are we trying to reconnect when'
                ' communicating with Identity API Server.'),
+    cfg.IntOpt('http_pool_maxsize',
+               default=10,
+               help='(Optional) Maximum number of connections to each'
+               ' Identity API Server host kept open for reuse.'),
+    cfg.BoolOpt('http_pool_block',
+                default=False,
+                help='(Optional) When all of the http_pool_maxsize'
+                ' connections to a host are in use, wait for one of them'
+                ' instead of opening another connection that is closed'
+                ' after the request.'),
     cfg.StrOpt('cache',
                default=None,
                help='Env key for the swift cache.'),
@@ -284,6 +317,105 @@ _OPTS = [
                ' tokens, the middleware caches previously-seen tokens for a'
                ' configurable duration (in seconds). Set to -1 to disable'
                ' caching completely.'),
+    cfg.IntOpt('memory_cache_size',
+               default=1000,
+               help='(Optional) Number of validated tokens to keep in an'
+               ' in-process cache in front of the token cache, so that'
+               ' recently seen tokens are validated without a round trip to'
+               ' memcached. Entries live no longer than token_cache_time,'
+               ' the token expiry, or the time the token has left in'
+               ' memcached. Set to 0 to disable the in-process cache.'),
+    cfg.IntOpt('memory_cache_shards',
+               default=1,
+               help='(Optional) Number of independently locked parts the'
+               ' in-process cache is split into. Under threaded WSGI'
+               ' servers, more shards let threads validating different'
+               ' tokens use the cache without waiting for each other.'),
+    cfg.BoolOpt('adaptive_token_cache_time', default=False,
+                help='(Optional) Keep tokens in the in-process cache for as'
+                ' long as they are valid, up to token_cache_time_max'
+                ' seconds, and for less while tokens are being revoked'
+                ' often: the rate of revocations seen in the revocation'
+                ' list over the last ten minutes or so bounds the time,'
+                ' down to token_cache_time_min seconds. Revocations are'
+                ' only seen when the revocation list is fetched, that is'
+                ' with PKI tokens or check_revocations_for_cached. Unless'
+                ' check_revocations_for_cached is set, tokens are still'
+                ' cached no longer than token_cache_time.'),
+    cfg.IntOpt('token_cache_time_min', default=10,
+               help='(Optional) Shortest time in seconds that'
+               ' adaptive_token_cache_time keeps a token cached, unless it'
+               ' expires sooner.'),
+    cfg.IntOpt('token_cache_time_max', default=3600,
+               help='(Optional) Longest time in seconds that'
+               ' adaptive_token_cache_time keeps a token cached when'
+               ' check_revocations_for_cached is set.'),
+    cfg.BoolOpt('lazy_service_catalog', default=False,
+                help='(Optional) Instead of the X-Service-Catalog header, set'
+                ' keystone.service_catalog in the request environment to an'
+                ' object that renders the catalog only if it is used, at most'
+                ' once per cached token. This saves encoding large catalogs'
+                ' as JSON, but only works with services that read'
+                ' keystone.service_catalog.'),
+    cfg.BoolOpt('phase_timings', default=False,
+                help='(Optional) Time each phase of token validation, such'
+                ' as cache lookups, hashing, revocation checks and signature'
+                ' verification, per token format. The timings are added to'
+                ' the process_request trace span and counted in-process.'),
+    cfg.IntOpt('phase_timings_log_interval', default=300,
+               help='(Optional) Seconds between logging the phase timings'
+               ' counted when phase_timings is enabled. Set to 0 to never'
+               ' log them.'),
+    cfg.StrOpt('memory_cache_snapshot',
+               help='(Optional) File the in-process token cache is saved to'
+               ' periodically, on SIGTERM and when the process exits, and'
+               ' loaded from in the background when a worker gets its first'
+               ' request, so that restarted workers do not validate every'
+               ' token again. PKI tokens, or all tokens if'
+               ' check_revocations_for_cached is set, are checked against'
+               ' the revocation list when loaded. Requires'
+               ' memcache_secret_key; the file is protected as'
+               ' memcache_security_strategy says, or with a MAC if it is'
+               ' not set. With MAC, UUID token ids in the file are readable'
+               ' by whoever can read the file, which is created readable by'
+               ' its owner only.'),
+    cfg.IntOpt('memory_cache_snapshot_interval', default=300,
+               help='(Optional) Seconds between saves of the in-process'
+               ' token cache to memory_cache_snapshot. Set to 0 to only'
+               ' save it on SIGTERM and at exit.'),
+    cfg.StrOpt('batch_validation_url',
+               help='(Optional) URL of a service that validates many tokens'
+               ' in one request. When set, tokens missing from the caches'
+               ' at the same time are POSTed together to it as {"tokens":'
+               ' [...]}, and it answers {"tokens": {token: token data or'
+               ' null}}. Tokens it cannot answer for are validated with the'
+               ' identity server one at a time.'),
+    cfg.FloatOpt('batch_validation_window',
+                 default=0.005,
+                 help='(Optional) Seconds to wait for more tokens to'
+                 ' validate before sending a batch to'
+                 ' batch_validation_url.'),
+    cfg.IntOpt('batch_validation_size',
+               default=100,
+               help='(Optional) Maximum number of tokens sent to'
+               ' batch_validation_url in one request.'),
+    cfg.IntOpt('negative_cache_size',
+               default=10000,
+               help='(Optional) Number of recently rejected tokens to'
+               ' remember in-process, so that they are rejected again'
+               ' without asking the token cache or the identity server.'
+               ' Set to 0 to disable.'),
+    cfg.FloatOpt('validation_rate_limit',
+                 default=0,
+                 help='(Optional) Maximum number of tokens per second each'
+                 ' client address may have validated by the identity server'
+                 ' or by PKI signature checks. Requests over the limit are'
+                 ' answered with 429 Too Many Requests. Set to 0 to'
+                 ' disable.'),
+    cfg.IntOpt('validation_rate_burst',
+               default=20,
+               help='(Optional) Number of validations a client address may'
+               ' make at once before validation_rate_limit applies.'),
     cfg.IntOpt('revocation_cache_time',
                default=10,
                help='Determines the frequency at which the list of revoked'
@@ -349,6 +481,23 @@ _OPTS = [
                 help='If true, the revocation list will be checked for cached'
                 ' tokens. This requires that PKI tokens are configured on the'
                 ' identity server.'),
+    cfg.BoolOpt('background_refresh', default=True,
+                help='(Optional) Once PKI tokens are seen, refresh the'
+                ' revocation list and the signing certificates from a'
+                ' background thread ahead of their expiry, so that requests'
+                ' do not wait for them to be fetched.'),
+    cfg.BoolOpt('revocation_bloom_filter', default=False,
+                help='(Optional) Keep a Bloom filter of the revocation list'
+                ' instead of a set of every revoked token. This uses less'
+                ' memory for very long revocation lists, at the cost of'
+                ' scanning the list for the rare tokens the filter cannot'
+                ' rule out.'),
+    cfg.BoolOpt('cms_verify_in_process', default=False,
+                help='(Optional) Verify the signatures of PKI tokens and the'
+                ' revocation list in-process rather than by running openssl.'
+                ' This requires the asn1crypto and cryptography libraries;'
+                ' without them, or for signatures it does not support, the'
+                ' middleware falls back to openssl.'),
     cfg.ListOpt('hash_algorithms', default=['md5'],
                 help='Hash algorithms to use for hashing PKI tokens. This may'
                 ' be a single algorithm or multiple. The algorithms are those'
@@ -418,6 +567,665 @@ def _get_project_version(project):
     return pkg_resources.get_distribution(project).version
 
 
+def _token_expires_at(data):
+    """Return the expiry of validated token data in seconds since the epoch."""
+    expires = access.AccessInfo.factory(body=data).expires
+    return calendar.timegm(expires.utctimetuple())
+
+
+def _token_format(token):
+    """Guess the format of a token from what it looks like."""
+    if cms.is_pkiz(token):
+        return 'pkiz'
+    elif cms.is_asn1_token(token):
+        return 'pki'
+    elif token.startswith('gAAAAA'):
+        # NOTE: every Fernet token starts with the version byte and a
+        # timestamp whose high bytes are zero, which encode like this.
+        return 'fernet'
+    return 'uuid'
+
+
+class _NullPhase(object):
+    """A phase context that measures nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class _Phase(object):
+    """Time a phase of token validation into _PhaseTimings."""
+
+    __slots__ = ('_timings', '_name', '_token_format', '_started')
+
+    def __init__(self, timings, name, token_format):
+        self._timings = timings
+        self._name = name
+        self._token_format = token_format
+
+    def __enter__(self):
+        self._started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.time() - self._started
+        self._timings.record(self._token_format, self._name, elapsed)
+        tomograph.tag('auth_token.%s' % self._name,
+                      '%.3fms' % (elapsed * 1000))
+        return False
+
+
+class _PhaseTimings(object):
+    """Counts and durations of token validation phases per token format.
+
+    Updating them costs a lock and a few arithmetic operations per phase.
+    Use snapshot() to pull the current values. If dump_interval is set, they
+    are also logged at most once per interval, piggybacking on requests so
+    no timer thread is needed.
+    """
+
+    def __init__(self, dump_interval=None, log=_LOG):
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._dump_interval = dump_interval
+        self._last_dump = time.time()
+        self._log = log
+
+    def record(self, token_format, phase, elapsed):
+        now = time.time()
+        key = (token_format, phase)
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = [0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += elapsed
+            if elapsed > stats[2]:
+                stats[2] = elapsed
+
+            dump = (self._dump_interval and
+                    now - self._last_dump >= self._dump_interval)
+            if dump:
+                self._last_dump = now
+        if dump:
+            self.dump()
+
+    def snapshot(self):
+        """Return a copy of the timings.
+
+        :returns: a dict mapping (token format, phase) to a dict of count,
+                  total_time and max_time.
+        """
+        with self._lock:
+            return dict((key, dict(count=stats[0], total_time=stats[1],
+                                   max_time=stats[2]))
+                        for key, stats in six.iteritems(self._stats))
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def dump(self):
+        """Log the timings, one line per token format and phase."""
+        for (token_format, phase), stats in sorted(
+                six.iteritems(self.snapshot()),
+                key=lambda item: (str(item[0][0]), item[0][1])):
+            self._log.info('auth_token %(format)s %(phase)s: '
+                           'count=%(count)d avg=%(avg).4fs max=%(max).4fs',
+                           {'format': token_format, 'phase': phase,
+                            'count': stats['count'],
+                            'avg': stats['total_time'] / stats['count'],
+                            'max': stats['max_time']})
+
+
+class _SingleFlight(object):
+    """Collapse concurrent calls for the same key into a single call.
+
+    The first caller for a key runs the function, later callers for the same
+    key block until it is done and then share its result or re-raise its
+    exception. Waiting uses threading.Event, which eventlet monkeypatches to
+    block only the calling greenthread.
+    """
+
+    class _Call(object):
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.exc_info = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+
+        if not leader:
+            call.event.wait()
+            if call.exc_info:
+                six.reraise(*call.exc_info)
+            return call.result
+
+        try:
+            call.result = func(*args)
+        except Exception:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+
+class _RateLimiter(object):
+    """Limit the rate of events per source with a token bucket each.
+
+    Only the most recently seen sources are tracked, so the memory used is
+    bounded however many sources there are.
+
+    :param float rate: events allowed per second
+    :param int burst: events allowed at once
+    """
+
+    _MAX_SOURCES = 10000
+
+    def __init__(self, rate, burst):
+        self._rate = rate
+        self._burst = max(burst, 1)
+        self._buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, source):
+        """Take an event from the bucket of source and return if allowed."""
+        now = time.time()
+        with self._lock:
+            tokens, last = self._buckets.pop(source, (self._burst, now))
+            tokens = min(self._burst, tokens + (now - last) * self._rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[source] = (tokens, now)
+            if len(self._buckets) > self._MAX_SOURCES:
+                self._buckets.popitem(last=False)
+        return allowed
+
+
+class _RecentlyRejected(exc.InvalidToken):
+    """The token was rejected recently and is not validated again."""
+
+
+class _RateLimited(Exception):
+    """The client has asked for too many token validations."""
+
+
+class _Refresher(object):
+    """Run refresh tasks in a daemon thread.
+
+    A task refreshes whatever is due to expire soon and returns the number
+    of seconds until it should run again. The thread waits a random part of
+    that time so that the workers of a service do not all call the identity
+    server at once. A failed task is retried sooner.
+
+    The thread is started on demand and started again in a forked child,
+    where it does not survive the fork. It stops once the objects of its
+    tasks are gone, such as a middleware that has been replaced.
+    """
+
+    _JITTER = (0.75, 0.9)
+    _RETRY_INTERVAL = 30
+
+    def __init__(self, log=_LOG):
+        self._log = log
+        self._tasks = []
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def add(self, method):
+        """Run a bound method once started, then again when it is due.
+
+        Only a weak reference to the object of the method is kept.
+        """
+        self._tasks.append((weakref.ref(six.get_method_self(method)),
+                            six.get_method_function(method)))
+
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            thread = threading.Thread(target=self._run,
+                                      name='auth_token refresher')
+            thread.daemon = True
+            thread.start()
+
+    def _run(self):
+        due = [0] * len(self._tasks)
+        while self._run_due(due):
+            time.sleep(max(min(due) - time.time(), 0))
+
+    def _run_due(self, due):
+        """Run the tasks that are due, or return False if they are gone."""
+        now = time.time()
+        for i, (ref, func) in enumerate(self._tasks):
+            if due[i] > now:
+                continue
+            # NOTE: the object is only referenced while its task runs, so
+            # that the thread does not keep it alive while sleeping.
+            obj = ref()
+            if obj is None:
+                self._log.debug('Stopping background refresh')
+                return False
+            try:
+                delay = func(obj)
+            except Exception:
+                self._log.warning(_LW('Background refresh failed'),
+                                  exc_info=True)
+                delay = self._RETRY_INTERVAL
+            finally:
+                del obj
+            due[i] = now + max(delay * random.uniform(*self._JITTER), 1)
+        return True
+
+
+def _save_snapshot_at_exit(ref):
+    saver = ref()
+    if saver is not None:
+        saver.save()
+
+
+class _SnapshotSaver(object):
+    """Load and save the in-process token cache of a middleware.
+
+    The snapshot is loaded from a daemon thread started with the first
+    request, as checking it may mean fetching the revocation list.
+
+    Workers seldom exit through atexit handlers: glance children are killed
+    by SIGTERM with its default action and oslo.service children leave
+    through os._exit. So the cache is also saved every interval seconds
+    from a daemon thread, and on SIGTERM while its default action is in
+    place. The signal handler only wakes the thread, which saves the cache
+    and raises the signal again with its default action; saving from the
+    handler could deadlock on a cache lock held by the interrupted code.
+
+    Only a weak reference to the middleware is kept, and the saver stops
+    with it.
+    """
+
+    def __init__(self, middleware, interval, log=_LOG):
+        self._ref = weakref.ref(middleware)
+        self._interval = interval
+        self._log = log
+        self._pid = None
+        self._loaded = False
+        self._terminating = None
+        self._refresher = None
+        if interval > 0:
+            self._refresher = _Refresher(log)
+            self._refresher.add(self._save_periodically)
+        self._skip_save = False
+        atexit.register(_save_snapshot_at_exit, weakref.ref(self))
+
+    def ensure_started(self):
+        """Start loading and saving in this process, if not done already."""
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        load = not self._loaded
+        self._loaded = True
+        if self._refresher is not None:
+            # NOTE: the refresher runs the task as soon as it starts, when
+            # there is nothing new to save.
+            self._skip_save = True
+            self._refresher.ensure_started()
+        # NOTE: a forked child inherits the handler, but not the thread.
+        self._terminating = threading.Event()
+        handle_signal = False
+        try:
+            if signal.getsignal(signal.SIGTERM) in (signal.SIG_DFL,
+                                                    self._on_signal):
+                signal.signal(signal.SIGTERM, self._on_signal)
+                handle_signal = True
+        except ValueError:
+            # NOTE: signal handlers can only be set from the main thread.
+            self._log.debug('Not saving the token cache snapshot on SIGTERM')
+        if load or handle_signal:
+            thread = threading.Thread(target=self._run,
+                                      args=(load, handle_signal),
+                                      name='auth_token snapshot')
+            thread.daemon = True
+            thread.start()
+
+    def _run(self, load, handle_signal):
+        if load:
+            middleware = self._ref()
+            try:
+                if middleware is not None:
+                    middleware._load_memory_cache_snapshot()
+            except Exception:
+                self._log.warning(_LW('Unable to load the token cache '
+                                      'snapshot'), exc_info=True)
+            del middleware
+        if handle_signal:
+            self._terminating.wait()
+            self.save()
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    def save(self):
+        middleware = self._ref()
+        if middleware is not None:
+            middleware._save_memory_cache_snapshot()
+
+    def _save_periodically(self):
+        if self._skip_save:
+            self._skip_save = False
+        else:
+            self.save()
+        return self._interval
+
+    def _on_signal(self, signum, frame):
+        signal.signal(signum, signal.SIG_DFL)
+        self._terminating.set()
+
+
+class _TokenBatcher(object):
+    """Validate tokens that miss the caches together in bulk requests.
+
+    The first token to arrive opens a batch and waits window seconds for
+    other requests to add theirs, then sends them all with one call to send
+    and hands each waiting request its own result.
+
+    :param send: called with a list of at most max_size tokens, returns a
+        dict from the tokens it has results for to their results
+    :param float window: seconds to gather tokens for
+    :param int max_size: the most tokens sent in one call
+    """
+
+    def __init__(self, send, window, max_size):
+        self._send = send
+        self._window = window
+        self._max_size = max(max_size, 1)
+        self._lock = threading.Lock()
+        self._pending = None
+
+    def validate(self, token):
+        """Return the result for token, or None if there is none."""
+        call = _SingleFlight._Call()
+        with self._lock:
+            leader = self._pending is None
+            if leader:
+                self._pending = []
+            self._pending.append((token, call))
+
+        if leader:
+            time.sleep(self._window)
+            with self._lock:
+                batch, self._pending = self._pending, None
+            for i in range(0, len(batch), self._max_size):
+                self._send_batch(batch[i:i + self._max_size])
+
+        call.event.wait()
+        if call.exc_info:
+            six.reraise(*call.exc_info)
+        return call.result
+
+    def _send_batch(self, batch):
+        try:
+            results = self._send([token for token, _call in batch])
+        except Exception:
+            exc_info = sys.exc_info()
+            for _token, call in batch:
+                call.exc_info = exc_info
+        else:
+            for token, call in batch:
+                call.result = results.get(token)
+        finally:
+            for _token, call in batch:
+                call.event.set()
+
+
+class _IdentityHTTPAdapter(session.TCPKeepAliveAdapter):
+    """A sized pool of kept-alive connections to the identity server.
+
+    At most pool_maxsize idle connections are kept per host. If more
+    requests than that are made at once, the extra connections are closed
+    after use, or with pool_block the requests wait for a pooled one
+    instead. It replaces the TCPKeepAliveAdapter of the Session, whose TCP
+    keepalive socket options it keeps.
+
+    Requests and connection failures are counted per host. A host is
+    reported unhealthy after failure_threshold failures in a row, and
+    healthy again after the next request that gets a response.
+
+    :param log: the logger health changes are logged to
+    :param int pool_maxsize: connections kept per host
+    :param bool pool_block: wait for a pooled connection when all are busy
+    :param int failure_threshold: failures in a row that make a host
+        unhealthy
+    """
+
+    def __init__(self, log, pool_maxsize, pool_block, failure_threshold=3):
+        self._log = log
+        self._failure_threshold = failure_threshold
+        self._stats_lock = threading.Lock()
+        self._stats = {}
+        # NOTE: urllib3 hands out pooled connections through a queue and
+        # guards it with threading locks, which eventlet monkey patching
+        # makes greenthread safe, as it does the lock above.
+        super(_IdentityHTTPAdapter, self).__init__(pool_maxsize=pool_maxsize,
+                                                   pool_block=pool_block)
+
+    @staticmethod
+    def _host(url):
+        parts = urllib.parse.urlsplit(url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        return '%s:%d' % (parts.hostname, port)
+
+    def send(self, request, **kwargs):
+        host = self._host(request.url)
+        try:
+            response = super(_IdentityHTTPAdapter, self).send(request,
+                                                              **kwargs)
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout):
+            self._record(host, failed=True)
+            raise
+        self._record(host, failed=False)
+        return response
+
+    def _record(self, host, failed):
+        with self._stats_lock:
+            stats = self._stats.get(host)
+            if stats is None:
+                stats = self._stats[host] = {'requests': 0, 'failures': 0,
+                                             'failures_in_a_row': 0,
+                                             'healthy': True}
+            stats['requests'] += 1
+            was_healthy = stats['healthy']
+            if failed:
+                stats['failures'] += 1
+                stats['failures_in_a_row'] += 1
+                stats['healthy'] = (stats['failures_in_a_row'] <
+                                    self._failure_threshold)
+            else:
+                stats['failures_in_a_row'] = 0
+                stats['healthy'] = True
+            healthy = stats['healthy']
+
+        if was_healthy and not healthy:
+            self._log.warning(_LW('Identity server %(host)s failed '
+                                  '%(count)d requests in a row'),
+                              {'host': host,
+                               'count': self._failure_threshold})
+        elif healthy and not was_healthy:
+            self._log.info(_LI('Identity server %s is reachable again'),
+                           host)
+
+    def stats(self):
+        """Return a dict from host to its request and connection counts.
+
+        Besides the counts kept here, connections says how many connections
+        were opened to the host, which is well below requests while
+        connections are reused.
+        """
+        with self._stats_lock:
+            result = dict((host, dict(stats))
+                          for host, stats in self._stats.items())
+        for key in list(self.poolmanager.pools.keys()):
+            pool = self.poolmanager.pools.get(key)
+            stats = pool and result.get('%s:%d' % (pool.host, pool.port))
+            if stats is not None:
+                stats['connections'] = (stats.get('connections', 0) +
+                                        pool.num_connections)
+        return result
+
+
+class _TokenHashes(object):
+    """The hashes of a PKI token, computed only when first needed.
+
+    The hash with the preferred algorithm is enough to find the token in the
+    in-process cache, so the others are not computed until it misses there
+    or a revocation check asks for them.
+    """
+
+    __slots__ = ('_token', '_algorithms', '_hashes')
+
+    def __init__(self, token, algorithms):
+        self._token = token
+        self._algorithms = algorithms
+        self._hashes = [None] * len(algorithms)
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def __getitem__(self, index):
+        token_hash = self._hashes[index]
+        if token_hash is None:
+            token_hash = cms.cms_hash_token(self._token,
+                                            mode=self._algorithms[index])
+            self._hashes[index] = token_hash
+        return token_hash
+
+    def __iter__(self):
+        for index in range(len(self._hashes)):
+            yield self[index]
+
+
+class _DeferredServiceCatalog(object):
+    """The service catalog of a token in V2 format, rendered on first use.
+
+    str() returns the JSON that would be in the X-Service-Catalog header. It
+    is rendered once per cache entry and kept there; the data attribute is
+    decoded from it for each request that reads it.
+    """
+
+    __slots__ = ('_entry', '_data')
+
+    def __init__(self, entry):
+        self._entry = entry
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = jsonutils.loads(str(self))
+        return self._data
+
+    def __str__(self):
+        entry = self._entry
+        if entry.service_catalog is None:
+            catalog = entry.auth_ref.service_catalog.get_data()
+            if entry.auth_ref.version == 'v3':
+                catalog = _request._v3_to_v2_catalog(catalog)
+            entry.service_catalog = jsonutils.dumps(catalog)
+        return entry.service_catalog
+
+
+class _TokenInfo(dict):
+    """The token data given to one request, copied when first used.
+
+    It starts as a shallow copy of the cached data, which is shared by every
+    request presenting the token, and decodes a copy of its own from the
+    serialized data before a value is read or anything is changed, so the
+    application is free to change it.
+    """
+
+    __slots__ = ('_serialized',)
+
+    def __init__(self, data, serialized):
+        super(_TokenInfo, self).__init__(data)
+        self._serialized = serialized
+
+    def _own(self):
+        serialized = self._serialized
+        if serialized is not None:
+            self._serialized = None
+            dict.update(self, jsonutils.loads(serialized))
+
+    def _owning(method):
+        def wrapper(self, *args, **kwargs):
+            self._own()
+            return method(self, *args, **kwargs)
+        wrapper.__name__ = method.__name__
+        wrapper.__doc__ = method.__doc__
+        return wrapper
+
+    for _name in ('__getitem__', '__setitem__', '__delitem__', '__iter__',
+                  'clear', 'copy', 'get', 'items', 'iteritems', 'itervalues',
+                  'pop', 'popitem', 'setdefault', 'update', 'values',
+                  'viewitems', 'viewvalues'):
+        if hasattr(dict, _name):
+            locals()[_name] = _owning(getattr(dict, _name))
+    del _name, _owning
+
+    def __reduce__(self):
+        # NOTE: copies and pickles of it are plain dicts.
+        self._own()
+        return dict, (dict(self),)
+
+
+class _CachedToken(object):
+    """Validated token data and what is derived from it on first use.
+
+    The expiry, the AccessInfo, the bind, the request headers and the
+    rendered service catalog of a token are the same for every request that
+    presents it, so they are kept with the data in the in-process cache
+    rather than worked out per request. The data is kept serialized as
+    well, for the copy each request is given in keystone.token_info.
+
+    signed is True for PKI and PKIZ tokens, which are checked against the
+    revocation list when validated.
+    """
+
+    __slots__ = ('data', 'serialized', 'signed', 'auth_ref', 'expires_at',
+                 'cached_at', 'bind', 'user_headers', 'service_headers',
+                 'service_catalog')
+
+    def __init__(self, data, expires_at=None, signed=False):
+        self.data = data
+        self.serialized = jsonutils.dumps(data)
+        self.signed = signed
+        self.auth_ref = None
+        self.expires_at = expires_at
+        self.cached_at = time.time()
+        self.bind = None
+        self.user_headers = None
+        self.service_headers = None
+        self.service_catalog = None
+
+
 class _BaseAuthProtocol(object):
     """A base class for AuthProtocol token checking implementations.
 
@@ -458,7 +1266,8 @@ class _BaseAuthProtocol(object):
 
         By default this method does not return a value.
         """
-        request.remove_auth_headers()
+        with self._phase('remove_auth_headers'):
+            request.remove_auth_headers()
 
         user_auth_ref = None
         serv_auth_ref = None
@@ -491,6 +1300,15 @@ class _BaseAuthProtocol(object):
         p = _user_plugin.UserAuthPlugin(user_auth_ref, serv_auth_ref)
         request.environ['keystone.token_auth'] = p
 
+    def _phase(self, name):
+        """Return a context manager timing a phase of token validation.
+
+        The base class measures nothing; subclasses may time the phase.
+
+        :param str name: the name of the phase
+        """
+        return _NULL_PHASE
+
     def _validate_token(self, auth_ref):
         """Perform the validation steps on the token.
 
@@ -508,7 +1326,9 @@ class _BaseAuthProtocol(object):
         data = self._fetch_token(token)
 
         try:
-            return data, access.AccessInfo.factory(body=data, auth_token=token)
+            with self._phase('access_info'):
+                return data, access.AccessInfo.factory(body=data,
+                                                       auth_token=token)
         except Exception:
             self.log.warning(_LW('Invalid token contents.'), exc_info=True)
             raise exc.InvalidToken(_('Token authorization failed'))
@@ -547,6 +1367,19 @@ class _BaseAuthProtocol(object):
         if self._enforce_token_bind == _BIND_MODE.DISABLED:
             return
 
+        self._check_token_bind(self._token_bind(auth_ref), req)
+
+    def _token_bind(self, auth_ref):
+        """Return the bind information of a token.
+
+        :param auth_ref: The token data
+        :type auth_ref: keystoneclient.access.AccessInfo
+
+        :raises exc.InvalidToken: if the token version is unknown
+
+        :returns: (bind type, identifier) pairs, empty if there is no bind
+        :rtype: tuple
+        """
         try:
             if auth_ref.version == 'v2.0':
                 bind = auth_ref['token']['bind']
@@ -557,6 +1390,16 @@ class _BaseAuthProtocol(object):
         except KeyError:
             bind = {}
 
+        return tuple(six.iteritems(bind or {}))
+
+    def _check_token_bind(self, bind, req):
+        """Check the bind information of a token against the request.
+
+        :param tuple bind: the pairs returned by _token_bind
+        :param req: the request presenting the token
+
+        :raises exc.InvalidToken: if the bind is not satisfied
+        """
         # permissive and strict modes don't require there to be a bind
         permissive = self._enforce_token_bind in (_BIND_MODE.PERMISSIVE,
                                                   _BIND_MODE.STRICT)
@@ -575,12 +1418,12 @@ class _BaseAuthProtocol(object):
         else:
             name = self._enforce_token_bind
 
-        if name and name not in bind:
+        if name and name not in (bind_type for bind_type, _ in bind):
             self.log.info(_LI('Named bind mode %s not in bind information'),
                           name)
             self._invalid_user_token()
 
-        for bind_type, identifier in six.iteritems(bind):
+        for bind_type, identifier in bind:
             if bind_type == _BIND_MODE.KERBEROS:
                 if req.auth_type != 'negotiate':
                     self.log.info(_LI('Kerberos credentials required and '
@@ -613,6 +1456,8 @@ class AuthProtocol(_BaseAuthProtocol):
 
     _SIGNING_CERT_FILE_NAME = 'signing_cert.pem'
     _SIGNING_CA_FILE_NAME = 'cacert.pem'
+    _CERT_REFRESH_INTERVAL = 3600
+    _SERVICE_CATALOG_ENV = 'keystone.service_catalog'
 
     def __init__(self, app, conf):
         # tomograph.start("AuthProtocol", "init", "127.0.0.1", 0)
@@ -657,6 +1502,7 @@ class AuthProtocol(_BaseAuthProtocol):
         self._delay_auth_decision = self._conf_get('delay_auth_decision')
         self._include_service_catalog = self._conf_get(
             'include_service_catalog')
+        self._lazy_service_catalog = self._conf_get('lazy_service_catalog')
         self._hash_algorithms = self._conf_get('hash_algorithms')
 
         # tomograph.annotate("create identity server", "AuthProtocol")
@@ -676,8 +1522,25 @@ class AuthProtocol(_BaseAuthProtocol):
 
         self._signing_directory = _signing_dir.SigningDirectory(
             directory_name=self._conf_get('signing_dir'), log=self.log)
+        self._cms_verifier = self._cms_verifier_factory()
 
+        self._token_cache_time = int(self._conf_get('token_cache_time'))
         self._token_cache = self._token_cache_factory()
+        self._memory_cache = self._memory_cache_factory()
+        self._memory_cache_ttl = self._memory_cache_ttl_factory()
+        self._token_hash_memo = (
+            None if self._memory_cache is None
+            else _cache.lru_cache(self._conf_get('memory_cache_size'),
+                                  self._conf_get('memory_cache_shards')))
+        self._validations = _SingleFlight()
+        self._rejected_tokens = self._rejected_tokens_factory()
+        self._rate_limiter = self._rate_limiter_factory()
+        self._token_batcher = self._token_batcher_factory()
+        self._local = threading.local()
+        self._phase_timings = None
+        if self._conf_get('phase_timings'):
+            self._phase_timings = _PhaseTimings(
+                self._conf_get('phase_timings_log_interval'), self.log)
 
         revocation_cache_timeout = datetime.timedelta(
             seconds=self._conf_get('revocation_cache_time'))
@@ -686,11 +1549,35 @@ class AuthProtocol(_BaseAuthProtocol):
                                                      self._identity_server,
                                                      self._cms_verify,
                                                      self.log)
+        self._revocation_index = _revocations.RevocationIndex(
+            self._revocations,
+            bloom_filter=self._conf_get('revocation_bloom_filter'),
+            on_revoked=self._evict_revoked,
+            log=self.log)
 
         self._check_revocations_for_cached = self._conf_get(
             'check_revocations_for_cached')
+
+        self._refresher = None
+        if self._conf_get('background_refresh'):
+            self._refresher = _Refresher(self.log)
+            self._refresher.add(self._refresh_certs)
+            self._refresher.add(self._refresh_revocations)
+
+        self._snapshot_keys = self._snapshot_keys_factory()
+        self._snapshot_saver = None
+        if self._snapshot_keys is not None:
+            self._snapshot_saver = _SnapshotSaver(
+                self, self._conf_get('memory_cache_snapshot_interval'),
+                self.log)
         # tomograph.stop("init");
 
+    def _phase(self, name):
+        if self._phase_timings is None:
+            return _NULL_PHASE
+        return _Phase(self._phase_timings, name,
+                      getattr(self._local, 'token_format', None))
+
     def _conf_get(self, name, group=_base.AUTHTOKEN_GROUP):
         # try config from paste-deploy first
         if name in self._conf:
@@ -712,12 +1599,29 @@ class AuthProtocol(_BaseAuthProtocol):
         # pdb.set_trace()
         tomograph.start_http("keystonemiddleware.auth_token.AuthProtocol[process_request]", "process_request", request)
         tomograph.add_trace_info_header(request.headers)
+        # NOTE: maps id(auth_ref) to its cache entry for the AccessInfo
+        # objects of this request, which stay alive until it is processed.
+        self._local.auth_ref_entries = {}
+        try:
+            return self._process_request(request)
+        finally:
+            self._local.auth_ref_entries = None
+            tomograph.stop("process_request")
 
+    def _process_request(self, request):
         self._token_cache.initialize(request.environ)
-
-        resp = super(AuthProtocol, self).process_request(request)
-        
-        tomograph.stop("process_request")
+        if self._snapshot_saver is not None:
+            self._snapshot_saver.ensure_started()
+        self._local.source = request.remote_addr
+        user_token = request.user_token
+        self._local.token_format = user_token and _token_format(user_token)
+
+        with self._phase('token_cache_prefetch'):
+            self._local.prefetched = self._prefetch_token_cache(request)
+        try:
+            resp = super(AuthProtocol, self).process_request(request)
+        finally:
+            self._local.prefetched = None
 
         if resp:
             return resp
@@ -742,11 +1646,18 @@ class AuthProtocol(_BaseAuthProtocol):
                 self._reject_request()
 
         if request.user_token_valid:
-            request.set_user_headers(request.token_auth._user_auth_ref,
-                                     self._include_service_catalog)
+            self._local.token_format = _token_format(request.user_token)
+            with self._phase('set_headers'):
+                self._set_cached_headers(request,
+                                         request.token_auth._user_auth_ref,
+                                         'user_headers')
 
         if request.service_token and request.service_token_valid:
-            request.set_service_headers(request.token_auth._serv_auth_ref)
+            self._local.token_format = _token_format(request.service_token)
+            with self._phase('set_headers'):
+                self._set_cached_headers(request,
+                                         request.token_auth._serv_auth_ref,
+                                         'service_headers')
 
         if self.log.isEnabledFor(logging.DEBUG):
             self.log.debug('Received request from %s',
@@ -790,14 +1701,24 @@ class AuthProtocol(_BaseAuthProtocol):
 
         :param str token: The token being presented by a user.
 
-        :returns: list of str token hashes.
+        :returns: sequence of str token hashes.
         """
-        if cms.is_asn1_token(token) or cms.is_pkiz(token):
-            return list(cms.cms_hash_token(token, mode=algo)
-                        for algo in self._hash_algorithms)
-        else:
+        if not (cms.is_asn1_token(token) or cms.is_pkiz(token)):
             return [token]
 
+        # NOTE: PKI tokens are several kilobytes and clients send the same
+        # one repeatedly, so remember the hashes rather than hash it again.
+        if self._token_hash_memo is not None:
+            token_hashes = self._token_hash_memo.get(token)
+            if token_hashes is not None:
+                return token_hashes
+
+        token_hashes = _TokenHashes(token, self._hash_algorithms)
+        if self._token_hash_memo is not None:
+            self._token_hash_memo.set(token, token_hashes,
+                                      self._token_cache_time)
+        return token_hashes
+
     def _cache_get_hashes(self, token_hashes):
         """Check if the token is cached already.
 
@@ -805,15 +1726,176 @@ class AuthProtocol(_BaseAuthProtocol):
         the first one that is present. If nothing is found in the cache it
         returns None.
 
-        :returns: token data if found else None.
+        :returns: a tuple of the token data and the time its cache entry
+                  expires, or None if unknown; None if nothing is found.
         """
+        prefetched = getattr(self._local, 'prefetched', None) or {}
 
         for token in token_hashes:
-            cached = self._token_cache.get(token)
+            if token in prefetched:
+                cached = prefetched[token]
+                if isinstance(cached, exc.InvalidToken):
+                    self.log.debug('Cached Token is marked unauthorized')
+                    raise cached
+            else:
+                cached = self._token_cache.get_with_expiry(token)
 
             if cached:
                 return cached
 
+    def _prefetch_token_cache(self, request):
+        """Fetch the cache entries of the tokens of a request in one trip.
+
+        The user and service tokens, and each hash a PKI token may be cached
+        as, would otherwise each cost a memcached get on a miss. Tokens
+        already in the in-process cache or recently rejected are skipped.
+
+        :returns: a dict for _cache_get_hashes, empty if there is nothing
+                  worth fetching together.
+        """
+        token_ids = []
+        for token in (request.user_token, request.service_token):
+            if not token:
+                continue
+            token_hashes = self._token_hashes(token)
+            # NOTE: recently rejected tokens are rejected without a lookup.
+            if not (self._memory_cache_get(token_hashes[0]) or
+                    self._recently_rejected(token_hashes[0])):
+                token_ids.extend(token_hashes)
+        if len(token_ids) < 2:
+            return {}
+
+        try:
+            return self._token_cache.get_multi(token_ids)
+        except Exception:
+            # NOTE: the lookups are made again one by one, which reports the
+            # error the usual way if it persists.
+            self.log.debug('Token cache prefetch failed', exc_info=True)
+            return {}
+
+    def _memory_cache_get(self, token_hash):
+        """Return the in-process cache entry for a token, or None."""
+        if self._memory_cache is None:
+            return None
+        entry = self._memory_cache.get(token_hash)
+        ttl = self._memory_cache_ttl
+        if (entry is not None and ttl is not None and
+                time.time() - entry.cached_at > ttl.limit()):
+            # NOTE: cached before revocations became more frequent.
+            self._memory_cache.pop(token_hash)
+            return None
+        return entry
+
+    def _memory_cache_store(self, token_hash, data, cache_expires_at=None,
+                            signed=False):
+        """Keep validated token data in the in-process cache.
+
+        The entry lives no longer than token_cache_time, or the time chosen
+        by adaptive_token_cache_time, nor past the expiry of the token
+        itself, nor past cache_expires_at when the data comes from
+        _token_cache and is only kept there until then.
+
+        :returns: the _CachedToken entry for data, even if it is not cached.
+        """
+        entry = _CachedToken(data, signed=signed)
+        try:
+            entry.expires_at = _token_expires_at(data)
+        except Exception:
+            # NOTE: malformed token data is rejected by _do_fetch_token, so
+            # there is no point in keeping it around.
+            return entry
+        if self._memory_cache is None:
+            return entry
+        if self._memory_cache_ttl is not None:
+            ttl = self._memory_cache_ttl.ttl(entry.expires_at)
+        else:
+            ttl = min(self._token_cache_time, entry.expires_at - time.time())
+        if cache_expires_at is not None:
+            ttl = min(ttl, cache_expires_at - time.time())
+        self._memory_cache.set(token_hash, entry, ttl)
+        return entry
+
+    def _evict_revoked(self, token_ids):
+        """Drop newly revoked tokens from the in-process cache."""
+        if self._memory_cache is None:
+            return
+        if self._memory_cache_ttl is not None:
+            self._memory_cache_ttl.revoked(len(token_ids))
+        for token_id in token_ids:
+            self._memory_cache.pop(token_id)
+
+    def _recently_rejected(self, token_hash):
+        return (self._rejected_tokens is not None and
+                token_hash in self._rejected_tokens)
+
+    def _store_invalid(self, token_hash):
+        if self._memory_cache is not None:
+            self._memory_cache.pop(token_hash)
+        if self._rejected_tokens is not None:
+            self._rejected_tokens.add(token_hash)
+        self._token_cache.store_invalid(token_hash)
+
+    def _do_fetch_token(self, token):
+        """Fetch a token and return its data and AccessInfo.
+
+        The AccessInfo is built once per cache entry and shared by every
+        request presenting the token. The data is a _TokenInfo, so that the
+        application gets its own copy if it uses keystone.token_info.
+        """
+        self._local.token_format = _token_format(token)
+        entry = self._fetch_token_entry(token)
+        auth_ref = entry.auth_ref
+        if auth_ref is None:
+            try:
+                with self._phase('access_info'):
+                    auth_ref = access.AccessInfo.factory(body=entry.data,
+                                                         auth_token=token)
+            except Exception:
+                self.log.warning(_LW('Invalid token contents.'),
+                                 exc_info=True)
+                raise exc.InvalidToken(_('Token authorization failed'))
+            entry.auth_ref = auth_ref
+        entries = getattr(self._local, 'auth_ref_entries', None)
+        if entries is not None:
+            entries[id(auth_ref)] = entry
+        return _TokenInfo(entry.data, entry.serialized), auth_ref
+
+    def _auth_ref_entry(self, auth_ref):
+        """Return the cache entry auth_ref was built from, or None."""
+        entries = getattr(self._local, 'auth_ref_entries', None)
+        return entries and entries.get(id(auth_ref))
+
+    def _set_cached_headers(self, request, auth_ref, kind):
+        """Set the user or service headers built from auth_ref.
+
+        The headers are built once per cache entry on a blank request and
+        copied into the environ of later requests for the same token.
+
+        :param str kind: 'user_headers' or 'service_headers'
+        """
+        entry = self._auth_ref_entry(auth_ref)
+        headers = getattr(entry, kind, None)
+        if headers is None:
+            blank = _request._AuthTokenRequest.blank('/')
+            environ = dict(blank.environ)
+            if kind == 'user_headers':
+                blank.set_user_headers(auth_ref,
+                                       self._include_service_catalog and
+                                       not self._lazy_service_catalog)
+            else:
+                blank.set_service_headers(auth_ref)
+            headers = dict((k, v) for k, v in six.iteritems(blank.environ)
+                           if k not in environ or environ[k] != v)
+            if entry is not None:
+                setattr(entry, kind, headers)
+        request.environ.update(headers)
+
+        if (kind == 'user_headers' and self._lazy_service_catalog and
+                self._include_service_catalog and entry is not None and
+                auth_ref.has_service_catalog()):
+            request.environ[self._SERVICE_CATALOG_ENV] = (
+                _DeferredServiceCatalog(entry))
+
     def _fetch_token(self, token):
         """Retrieve a token from either a PKI bundle or the identity server.
 
@@ -821,27 +1903,56 @@ class AuthProtocol(_BaseAuthProtocol):
 
         :raises exc.InvalidToken: if token is rejected
         """
-        data = None
-        token_hashes = None
+        return self._fetch_token_entry(token).data
 
-        try:
-            token_hashes = self._token_hashes(token)
-            cached = self._cache_get_hashes(token_hashes)
+    def _fetch_token_entry(self, token):
+        """Retrieve a token and return its _CachedToken entry.
 
-            if cached:
-                data = cached
+        :param str token: token id
+
+        :raises exc.InvalidToken: if token is rejected
+        """
+        entry = None
+        token_hashes = None
 
+        try:
+            with self._phase('token_hashing'):
+                token_hashes = self._token_hashes(token)
+                # NOTE: PKI token hashes are computed when first indexed,
+                # so compute the preferred one within this phase.
+                token_hashes[0]
+            with self._phase('memory_cache_lookup'):
+                entry = self._memory_cache_get(token_hashes[0])
+            if not entry:
+                if self._recently_rejected(token_hashes[0]):
+                    raise _RecentlyRejected(_('Token authorization failed'))
+                with self._phase('token_cache_lookup'):
+                    cached = self._cache_get_hashes(token_hashes)
+                if cached:
+                    entry = self._memory_cache_store(
+                        token_hashes[0], *cached,
+                        signed=_token_format(token) in ('pki', 'pkiz'))
+
+            if entry:
                 if self._check_revocations_for_cached:
+                    self._start_refresher()
                     # A token stored in Memcached might have been revoked
                     # regardless of initial mechanism used to validate it,
-                    # and needs to be checked.
-                    self._revocations.check(token_hashes)
+                    # and needs to be checked. If it has been, the generic
+                    # handler below evicts it from the in-process cache.
+                    with self._phase('revocation_check'):
+                        self._revocation_index.check(token_hashes)
             else:
-                data = self._validate_offline(token, token_hashes)
-                if not data:
-                    data = self._identity_server.verify_token(token)
+                if (self._rate_limiter is not None and
+                        not self._rate_limiter.allow(
+                            getattr(self._local, 'source', None))):
+                    raise _RateLimited()
 
-                self._token_cache.store(token_hashes[0], data)
+                # NOTE: concurrent requests carrying the same new token wait
+                # for a single validation instead of each asking keystone.
+                entry = self._validations.do(token_hashes[0],
+                                             self._validate_uncached,
+                                             token, token_hashes)
 
         except (exceptions.ConnectionRefused, exceptions.RequestTimeout):
             self.log.debug('Token validation failure.', exc_info=True)
@@ -850,16 +1961,73 @@ class AuthProtocol(_BaseAuthProtocol):
         except exc.ServiceError as e:
             self.log.critical(_LC('Unable to obtain admin token: %s'), e)
             raise webob.exc.HTTPServiceUnavailable()
+        except _RecentlyRejected:
+            self.log.debug('Token was rejected recently.')
+            raise
+        except _RateLimited:
+            self.log.warning(_LW('Too many token validations from %s'),
+                             getattr(self._local, 'source', None))
+            raise webob.exc.HTTPTooManyRequests()
         except Exception:
             self.log.debug('Token validation failure.', exc_info=True)
             if token_hashes:
-                self._token_cache.store_invalid(token_hashes[0])
+                self._store_invalid(token_hashes[0])
             self.log.warning(_LW('Authorization failed for token'))
             raise exc.InvalidToken(_('Token authorization failed'))
 
-        return data
+        return entry
+
+    def _validate_uncached(self, token, token_hashes):
+        """Validate a token which is not cached and cache the result."""
+        data = self._validate_offline(token, token_hashes)
+        if not data:
+            data = self._verify_token_online(token)
+
+        self._token_cache.store(token_hashes[0], data)
+        return self._memory_cache_store(
+            token_hashes[0], data,
+            signed=_token_format(token) in ('pki', 'pkiz'))
+
+    def _verify_token_online(self, token):
+        """Validate a token with the identity server, in a batch if set."""
+        with self._phase('verify_token'):
+            return self._verify_token_remote(token)
+
+    def _verify_token_remote(self, token):
+        if self._token_batcher is None:
+            return self._identity_server.verify_token(token)
+
+        try:
+            data = self._token_batcher.validate(token)
+        except Exception:
+            self.log.warning(_LW('Batch token validation failed, '
+                                 'fallback to single validation.'),
+                             exc_info=True)
+        else:
+            if data:
+                return data
+            elif data is False:
+                raise exc.InvalidToken(_('Token authorization failed'))
+        # NOTE: tokens left out of the batch response are validated alone.
+        return self._identity_server.verify_token(token)
+
+    def _verify_token_batch(self, tokens):
+        """POST tokens to batch_validation_url.
+
+        :returns: dict from token to its data, or to False if it is invalid.
+        """
+        body = {'tokens': tokens}
+        if not self._include_service_catalog:
+            body['nocatalog'] = True
+        resp = self._identity_adapter.post(
+            self._conf_get('batch_validation_url'), json=body,
+            authenticated=True)
+        return dict((token, data or False) for token, data in
+                    six.iteritems(resp.json()['tokens']))
 
     def _validate_offline(self, token, token_hashes):
+        if cms.is_pkiz(token) or cms.is_asn1_token(token):
+            self._start_refresher()
         try:
             if cms.is_pkiz(token):
                 verified = self._verify_pkiz_token(token, token_hashes)
@@ -879,12 +2047,30 @@ class AuthProtocol(_BaseAuthProtocol):
             return data
 
     def _validate_token(self, auth_ref):
-        super(AuthProtocol, self)._validate_token(auth_ref)
+        entry = self._auth_ref_entry(auth_ref)
+        if entry is None or entry.expires_at is None:
+            super(AuthProtocol, self)._validate_token(auth_ref)
+        elif entry.expires_at <= time.time():
+            # NOTE: the same check as will_expire_soon(stale_duration=0),
+            # against the expiry parsed once when the token was cached.
+            raise exc.InvalidToken(_('Token authorization failed'))
 
         if auth_ref.version == 'v2.0' and not auth_ref.project_id:
             msg = _('Unable to determine service tenancy.')
             raise exc.InvalidToken(msg)
 
+    def _confirm_token_bind(self, auth_ref, req):
+        if self._enforce_token_bind == _BIND_MODE.DISABLED:
+            return
+
+        entry = self._auth_ref_entry(auth_ref)
+        if entry is None:
+            return super(AuthProtocol, self)._confirm_token_bind(auth_ref,
+                                                                 req)
+        if entry.bind is None:
+            entry.bind = self._token_bind(auth_ref)
+        self._check_token_bind(entry.bind, req)
+
     def _cms_verify(self, data, inform=cms.PKI_ASN1_FORM):
         """Verifies the signature of the provided data's IAW CMS syntax.
 
@@ -893,6 +2079,12 @@ class AuthProtocol(_BaseAuthProtocol):
         """
         def verify():
             try:
+                if self._cms_verifier is not None:
+                    try:
+                        return self._cms_verifier.verify(data).decode('utf-8')
+                    except _cms.UnsupportedCMS as err:
+                        self.log.debug('Falling back to openssl to verify '
+                                       'CMS data with unsupported %s', err)
                 signing_cert_path = self._signing_directory.calc_path(
                     self._SIGNING_CERT_FILE_NAME)
                 signing_ca_path = self._signing_directory.calc_path(
@@ -900,12 +2092,14 @@ class AuthProtocol(_BaseAuthProtocol):
                 return cms.cms_verify(data, signing_cert_path,
                                       signing_ca_path,
                                       inform=inform).decode('utf-8')
-            except cms.subprocess.CalledProcessError as err:
+            except (cms.subprocess.CalledProcessError,
+                    exceptions.CMSError) as err:
                 self.log.warning(_LW('Verify error: %s'), err)
                 raise
 
         try:
-            return verify()
+            with self._phase('cms_verify'):
+                return verify()
         except exceptions.CertificateConfigError:
             # the certs might be missing; unconditionally fetch to avoid racing
             self._fetch_signing_cert()
@@ -920,15 +2114,28 @@ class AuthProtocol(_BaseAuthProtocol):
                 self.log.error(_LE('CMS Verify output: %s'), err.output)
                 raise
 
+    def _cms_verifier_factory(self):
+        if not self._conf_get('cms_verify_in_process'):
+            return None
+        if not _cms.is_available():
+            self.log.info(_LI('asn1crypto and cryptography are not available, '
+                              'PKI tokens will be verified with openssl.'))
+            return None
+        return _cms.CMSVerifier(
+            self._signing_directory.calc_path(self._SIGNING_CERT_FILE_NAME),
+            self._signing_directory.calc_path(self._SIGNING_CA_FILE_NAME))
+
     def _verify_signed_token(self, signed_text, token_ids):
         """Check that the token is unrevoked and has a valid signature."""
-        self._revocations.check(token_ids)
+        with self._phase('revocation_check'):
+            self._revocation_index.check(token_ids)
         formatted = cms.token_to_cms(signed_text)
         verified = self._cms_verify(formatted)
         return verified
 
     def _verify_pkiz_token(self, signed_text, token_ids):
-        self._revocations.check(token_ids)
+        with self._phase('revocation_check'):
+            self._revocation_index.check(token_ids)
         try:
             uncompressed = cms.pkiz_uncompress(signed_text)
             verified = self._cms_verify(uncompressed, inform=cms.PKIZ_CMS_FORM)
@@ -937,6 +2144,48 @@ class AuthProtocol(_BaseAuthProtocol):
         except TypeError:
             raise exc.InvalidToken(signed_text)
 
+    def _start_refresher(self):
+        # NOTE: only deployments using PKI tokens need the revocation list
+        # and certificates, so the refresher starts with the first one seen.
+        if self._refresher is not None:
+            self._refresher.ensure_started()
+
+    def _refresh_certs(self):
+        """Fetch the certificates if missing or about to expire."""
+        expiring = False
+        if self._cms_verifier is not None:
+            try:
+                signing_certs, _ca_certs = self._cms_verifier._load_certs()
+            except exceptions.CertificateConfigError:
+                expiring = True
+            else:
+                renew_at = (datetime.datetime.utcnow() +
+                            datetime.timedelta(
+                                seconds=self._CERT_REFRESH_INTERVAL * 2))
+                expiring = any(cert.not_valid_after < renew_at
+                               for cert in signing_certs)
+
+        for name, fetch in ((self._SIGNING_CERT_FILE_NAME,
+                             self._fetch_signing_cert),
+                            (self._SIGNING_CA_FILE_NAME,
+                             self._fetch_ca_cert)):
+            if expiring or not os.path.exists(
+                    self._signing_directory.calc_path(name)):
+                fetch()
+        return self._CERT_REFRESH_INTERVAL
+
+    def _refresh_revocations(self):
+        """Fetch the revocation list if it is about to expire."""
+        timeout = self._revocations._cache_timeout
+        expires_in = (self._revocations._fetched_time + timeout -
+                      datetime.datetime.utcnow())
+        if expires_in < timeout // 4:
+            self._revocations._list = self._revocations._fetch()
+            expires_in = timeout
+        # NOTE: index the list here rather than in the next request.
+        self._revocation_index.check(())
+        return expires_in.total_seconds()
+
     def _fetch_signing_cert(self):
         self._signing_directory.write_file(
             self._SIGNING_CERT_FILE_NAME,
@@ -1039,6 +2288,14 @@ class AuthProtocol(_BaseAuthProtocol):
             timeout=self._conf_get('http_connect_timeout'),
             user_agent=self._build_useragent_string()
         ))
+        # NOTE: requests keeps connections alive by default, but its pools
+        # are sized for a client, not a burst of concurrent validations.
+        self._identity_pool = _IdentityHTTPAdapter(
+            self.log,
+            pool_maxsize=self._conf_get('http_pool_maxsize'),
+            pool_block=self._conf_get('http_pool_block'))
+        for prefix in ('https://', 'http://'):
+            sess.session.mount(prefix, self._identity_pool)
         # tomograph.annotate("construct session", "AuthProtocol")
 
         auth_plugin = self._get_auth_plugin()
@@ -1049,6 +2306,7 @@ class AuthProtocol(_BaseAuthProtocol):
             service_type='identity',
             interface='admin',
             connect_retries=self._conf_get('http_request_max_retries'))
+        self._identity_adapter = adap
         # tomograph.annotate("create adapter", "AuthProtocol")
 
         auth_version = self._conf_get('auth_version')
@@ -1065,7 +2323,7 @@ class AuthProtocol(_BaseAuthProtocol):
         security_strategy = self._conf_get('memcache_security_strategy')
 
         cache_kwargs = dict(
-            cache_time=int(self._conf_get('token_cache_time')),
+            cache_time=self._token_cache_time,
             env_cache_name=self._conf_get('cache'),
             memcached_servers=self._conf_get('memcached_servers'),
             use_advanced_pool=self._conf_get('memcache_use_advanced_pool'),
@@ -1089,6 +2347,160 @@ class AuthProtocol(_BaseAuthProtocol):
         else:
             return _cache.TokenCache(self.log, **cache_kwargs)
 
+    def _rejected_tokens_factory(self):
+        size = self._conf_get('negative_cache_size')
+        if size <= 0:
+            return None
+        # NOTE: a rejected token stays rejected, the period only bounds how
+        # long a filter keeps filling up before it is rotated out.
+        return _cache.RejectedTokens(size, max(self._token_cache_time, 60))
+
+    def _snapshot_keys_factory(self):
+        if (self._memory_cache is None or
+                not self._conf_get('memory_cache_snapshot')):
+            return None
+        secret_key = self._conf_get('memcache_secret_key')
+        if not secret_key:
+            self.log.warning(_LW('memory_cache_snapshot requires '
+                                 'memcache_secret_key, the in-process token '
+                                 'cache will not be saved.'))
+            return None
+        strategy = (self._conf_get('memcache_security_strategy') or
+                    'MAC').upper()
+        return _memcache_crypt.derive_keys(b'memory_cache_snapshot',
+                                           secret_key.encode('utf-8'),
+                                           strategy.encode('utf-8'))
+
+    def _read_memory_cache_snapshot(self):
+        """Return the unexpired entries saved in the snapshot file."""
+        path = self._conf_get('memory_cache_snapshot')
+        try:
+            with open(path, 'rb') as f:
+                protected = f.read()
+        except (IOError, OSError):
+            return []
+        try:
+            entries = jsonutils.loads(_memcache_crypt.unprotect_data(
+                self._snapshot_keys, protected).decode('utf-8'))
+        except Exception:
+            self.log.warning(_LW('Ignoring invalid token cache snapshot %s'),
+                             path, exc_info=True)
+            return []
+        now = time.time()
+        return [entry for entry in entries if entry[2] > now]
+
+    def _load_memory_cache_snapshot(self):
+        """Fill the in-process cache with the unrevoked saved tokens.
+
+        Saved tokens are checked against the revocation list only where
+        cached tokens would be: PKI tokens, and any token if
+        check_revocations_for_cached is set. Those are left out if the
+        list cannot be fetched. None is kept longer than token_cache_time,
+        as in memcached.
+        """
+        entries = self._read_memory_cache_snapshot()
+        if not entries:
+            return
+        loaded = 0
+        unavailable = False
+        now = time.time()
+        for entry in entries:
+            token_hash, data, cache_expires_at, expires_at = entry[:4]
+            # NOTE: snapshots saved before the format was recorded are
+            # treated as PKI.
+            signed = entry[4] if len(entry) > 4 else True
+            if self._check_revocations_for_cached or signed:
+                if unavailable:
+                    continue
+                try:
+                    self._revocation_index.check([token_hash])
+                except exc.InvalidToken:
+                    continue
+                except Exception:
+                    self.log.warning(_LW('Unable to fetch the revocation '
+                                         'list, the tokens of the token '
+                                         'cache snapshot that need checking '
+                                         'are not loaded.'), exc_info=True)
+                    unavailable = True
+                    continue
+            ttl = min(cache_expires_at - now, self._token_cache_time)
+            self._memory_cache.set(token_hash,
+                                   _CachedToken(data, expires_at, signed),
+                                   ttl)
+            loaded += 1
+        self.log.debug('Loaded %d tokens from the token cache snapshot',
+                       loaded)
+
+    def _save_memory_cache_snapshot(self):
+        """Merge the in-process cache into the snapshot file.
+
+        Every worker of a service saves its cache to the same file, so the
+        entries already there are kept too, up to the size of the cache.
+        Tokens that are in the revocation list as last fetched are left
+        out, whichever worker saved them; it is not fetched again to save.
+        """
+        path = self._conf_get('memory_cache_snapshot')
+        try:
+            revoked = self._revocation_index._index[1]
+            entries = dict((entry[0], entry)
+                           for entry in self._read_memory_cache_snapshot())
+            for token_hash, cached, cache_expires_at in (
+                    self._memory_cache.items()):
+                previous = entries.get(token_hash)
+                if previous is None or previous[2] < cache_expires_at:
+                    entries[token_hash] = (token_hash, cached.data,
+                                           cache_expires_at,
+                                           cached.expires_at, cached.signed)
+            entries = sorted((entry for entry in six.itervalues(entries)
+                              if entry[0] not in revoked),
+                             key=lambda e: e[2], reverse=True)
+            entries = entries[:self._conf_get('memory_cache_size')]
+
+            protected = _memcache_crypt.protect_data(
+                self._snapshot_keys, jsonutils.dumps(entries).encode('utf-8'))
+            with tempfile.NamedTemporaryFile(
+                    dir=os.path.dirname(os.path.abspath(path)),
+                    delete=False) as f:
+                f.write(protected)
+            os.rename(f.name, path)
+        except Exception:
+            self.log.warning(_LW('Unable to save the token cache snapshot '
+                                 '%s'), path, exc_info=True)
+
+    def _token_batcher_factory(self):
+        if not self._conf_get('batch_validation_url'):
+            return None
+        return _TokenBatcher(self._verify_token_batch,
+                             self._conf_get('batch_validation_window'),
+                             self._conf_get('batch_validation_size'))
+
+    def _rate_limiter_factory(self):
+        rate = self._conf_get('validation_rate_limit')
+        if rate <= 0:
+            return None
+        return _RateLimiter(rate, self._conf_get('validation_rate_burst'))
+
+    def _memory_cache_factory(self):
+        # NOTE: the in-process cache sits in front of _token_cache, so it is
+        # off whenever token caching is disabled altogether.
+        size = self._conf_get('memory_cache_size')
+        if size <= 0 or self._token_cache_time < 0:
+            return None
+        return _cache.lru_cache(size, self._conf_get('memory_cache_shards'))
+
+    def _memory_cache_ttl_factory(self):
+        if (self._memory_cache is None or
+                not self._conf_get('adaptive_token_cache_time')):
+            return None
+        max_ttl = self._conf_get('token_cache_time_max')
+        if not self._conf_get('check_revocations_for_cached'):
+            # NOTE: only check_revocations_for_cached makes sure a cached
+            # token is checked against the revocation list, so without it
+            # tokens may not stay cached any longer than usual.
+            max_ttl = min(max_ttl, self._token_cache_time)
+        return _cache.AdaptiveTTL(self._conf_get('token_cache_time_min'),
+                                  max_ttl)
+
 
 def filter_factory(global_conf, **local_conf):
     """Returns a WSGI filter app for use with paste.deploy."""
@@ -0,0 +1,654 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+import contextlib
+import hashlib
+import math
+import threading
+import time
+
+from oslo_serialization import jsonutils
+import six
+
+from keystonemiddleware.auth_token import _exceptions as exc
+from keystonemiddleware.auth_token import _memcache_crypt as memcache_crypt
+from keystonemiddleware.i18n import _, _LE
+from keystonemiddleware.openstack.common import memorycache
+
+
+def _hash_key(key):
+    """Turn a set of arguments into a SHA256 hash.
+
+    Using a known-length cache key is important to ensure that memcache
+    maximum key length is not exceeded causing failures to validate.
+    """
+    if isinstance(key, six.text_type):
+        # NOTE(morganfainberg): Ensure we are always working with a bytes
+        # type required for the hasher. In python 2.7 it is possible to
+        # get a text_type (unicode). In python 3.4 all strings are
+        # text_type and not bytes by default. This encode coerces the
+        # text_type to the appropriate bytes values.
+        key = key.encode('utf-8')
+    return hashlib.sha256(key).hexdigest()
+
+
+class _CachePool(list):
+    """A lazy pool of cache references."""
+
+    def __init__(self, cache, memcached_servers):
+        self._environment_cache = cache
+        self._memcached_servers = memcached_servers
+
+    @contextlib.contextmanager
+    def reserve(self):
+        """Context manager to manage a pooled cache reference."""
+        if self._environment_cache is not None:
+            # skip pooling and just use the cache from the upstream filter
+            yield self._environment_cache
+            return  # otherwise the context manager will continue!
+
+        try:
+            c = self.pop()
+        except IndexError:
+            # the pool is empty, so we need to create a new client
+            c = memorycache.get_client(self._memcached_servers)
+
+        try:
+            yield c
+        finally:
+            self.append(c)
+
+
+class _MemcacheClientPool(object):
+    """An advanced memcached client pool that is eventlet safe."""
+    def __init__(self, memcache_servers, memcache_dead_retry=None,
+                 memcache_pool_maxsize=None, memcache_pool_unused_timeout=None,
+                 memcache_pool_conn_get_timeout=None,
+                 memcache_pool_socket_timeout=None):
+        # NOTE(morganfainberg): import here to avoid hard dependency on
+        # python-memcached library.
+        global _memcache_pool
+        from keystonemiddleware.auth_token import _memcache_pool
+
+        self._pool = _memcache_pool.MemcacheClientPool(
+            memcache_servers,
+            arguments={
+                'dead_retry': memcache_dead_retry,
+                'socket_timeout': memcache_pool_socket_timeout,
+            },
+            maxsize=memcache_pool_maxsize,
+            unused_timeout=memcache_pool_unused_timeout,
+            conn_get_timeout=memcache_pool_conn_get_timeout,
+        )
+
+    @contextlib.contextmanager
+    def reserve(self):
+        with self._pool.get() as client:
+            yield client
+
+
+class TokenCache(object):
+    """Encapsulates the auth_token token cache functionality.
+
+    auth_token caches tokens that it's seen so that when a token is re-used the
+    middleware doesn't have to do a more expensive operation (like going to the
+    identity server) to validate the token.
+
+    initialize() must be called before calling the other methods.
+
+    Store a valid token in the cache using store(); mark a token as invalid in
+    the cache using store_invalid().
+
+    Check if a token is in the cache and retrieve it using get(), along with
+    the time the cache entry expires using get_with_expiry(), or look up
+    several tokens at once using get_multi().
+
+    """
+
+    _CACHE_KEY_TEMPLATE = 'tokens/%s'
+    _INVALID_INDICATOR = 'invalid'
+
+    def __init__(self, log, cache_time=None,
+                 env_cache_name=None, memcached_servers=None,
+                 use_advanced_pool=False, memcache_pool_dead_retry=None,
+                 memcache_pool_maxsize=None, memcache_pool_unused_timeout=None,
+                 memcache_pool_conn_get_timeout=None,
+                 memcache_pool_socket_timeout=None):
+        self._LOG = log
+        self._cache_time = cache_time
+        self._env_cache_name = env_cache_name
+        self._memcached_servers = memcached_servers
+        self._use_advanced_pool = use_advanced_pool
+        self._memcache_pool_dead_retry = memcache_pool_dead_retry,
+        self._memcache_pool_maxsize = memcache_pool_maxsize,
+        self._memcache_pool_unused_timeout = memcache_pool_unused_timeout
+        self._memcache_pool_conn_get_timeout = memcache_pool_conn_get_timeout
+        self._memcache_pool_socket_timeout = memcache_pool_socket_timeout
+
+        self._cache_pool = None
+        self._use_get_multi = False
+        self._initialized = False
+
+    def _get_cache_pool(self, cache, memcache_servers, use_advanced_pool=False,
+                        memcache_dead_retry=None, memcache_pool_maxsize=None,
+                        memcache_pool_unused_timeout=None,
+                        memcache_pool_conn_get_timeout=None,
+                        memcache_pool_socket_timeout=None):
+        if use_advanced_pool is True and memcache_servers and cache is None:
+            return _MemcacheClientPool(
+                memcache_servers,
+                memcache_dead_retry=memcache_dead_retry,
+                memcache_pool_maxsize=memcache_pool_maxsize,
+                memcache_pool_unused_timeout=memcache_pool_unused_timeout,
+                memcache_pool_conn_get_timeout=memcache_pool_conn_get_timeout,
+                memcache_pool_socket_timeout=memcache_pool_socket_timeout)
+        else:
+            return _CachePool(cache, memcache_servers)
+
+    def initialize(self, env):
+        if self._initialized:
+            return
+
+        env_cache = env.get(self._env_cache_name)
+        # NOTE: a cache from the upstream filter, like swift's MemcacheRing,
+        # may not spread the keys of a get_multi over its servers as it does
+        # for single gets, so only our own clients fetch several keys at once.
+        self._use_get_multi = env_cache is None
+        self._cache_pool = self._get_cache_pool(
+            env_cache,
+            self._memcached_servers,
+            use_advanced_pool=self._use_advanced_pool,
+            memcache_dead_retry=self._memcache_pool_dead_retry,
+            memcache_pool_maxsize=self._memcache_pool_maxsize,
+            memcache_pool_unused_timeout=self._memcache_pool_unused_timeout,
+            memcache_pool_conn_get_timeout=self._memcache_pool_conn_get_timeout
+        )
+
+        self._initialized = True
+
+    def store(self, token_id, data):
+        """Put token data into the cache.
+        """
+        self._LOG.debug('Storing token in cache')
+        if self._cache_time:
+            # NOTE: the expiry of the entry lets a cache in front of this one
+            # keep the token no longer than it is kept here.
+            data = (data, time.time() + self._cache_time)
+        self._cache_store(token_id, data)
+
+    def store_invalid(self, token_id):
+        """Store invalid token in cache."""
+        self._LOG.debug('Marking token as unauthorized in cache')
+        self._cache_store(token_id, self._INVALID_INDICATOR)
+
+    def _get_cache_key(self, token_id):
+        """Get a unique key for this token id.
+
+        Turn the token_id into something that can uniquely identify that token
+        in a key value store.
+
+        As this is generally the first function called in a key lookup this
+        function also returns a context object. This context object is not
+        modified or used by the Cache object but is passed back on subsequent
+        functions so that decryption or other data can be shared throughout a
+        cache lookup.
+
+        :param str token_id: The unique token id.
+
+        :returns: A tuple of a string key and an implementation specific
+                  context object
+        """
+        # NOTE(jamielennox): in the basic implementation there is no need for
+        # a context so just pass None as it will only get passed back later.
+        unused_context = None
+        return self._CACHE_KEY_TEMPLATE % _hash_key(token_id), unused_context
+
+    def _deserialize(self, data, context):
+        """Deserialize data from the cache back into python objects.
+
+        Take data retrieved from the cache and return an appropriate python
+        dictionary.
+
+        :param str data: The data retrieved from the cache.
+        :param object context: The context that was returned from
+                               _get_cache_key.
+
+        :returns: The python object that was saved.
+        """
+        # memory cache will handle deserialization for us
+        return data
+
+    def _serialize(self, data, context):
+        """Serialize data so that it can be saved to the cache.
+
+        Take python objects and serialize them so that they can be saved into
+        the cache.
+
+        :param object data: The data to be cached.
+        :param object context: The context that was returned from
+                               _get_cache_key.
+
+        :returns: The python object that was saved.
+        """
+        # memory cache will handle serialization for us
+        return data
+
+    def _decode(self, serialized, context):
+        """Turn a raw cache entry back into what was stored.
+
+        :returns: A tuple of the cached token data, or _INVALID_INDICATOR,
+                  and the time the cache entry expires or None if unknown;
+                  None if the entry is missing or cannot be read.
+        """
+        if serialized is None:
+            return None
+
+        if isinstance(serialized, six.text_type):
+            serialized = serialized.encode('utf8')
+        data = self._deserialize(serialized, context)
+        if data is None:
+            return None
+
+        # Note that _INVALID_INDICATOR and (data, expires) are the only
+        # valid types of serialized cache entries, so there is not
+        # a collision with jsonutils.loads(serialized) == None.
+        if not isinstance(data, six.string_types):
+            data = data.decode('utf-8')
+        cached = jsonutils.loads(data)
+
+        # NOTE(jamielennox): Cached values used to be stored as a tuple of data
+        # and expiry time. They no longer are but we have to allow some time to
+        # transition the old format so if it's a tuple just return the data.
+        # NOTE: they are a tuple of data and the expiry of the cache entry
+        # again, which may wrap a tuple in the old format.
+        expires = None
+        while isinstance(cached, list) and len(cached) == 2:
+            cached, entry_expires = cached
+            if (expires is None and not isinstance(entry_expires, bool) and
+                    isinstance(entry_expires, (int, float))):
+                expires = entry_expires
+
+        return cached, expires
+
+    def _check_valid(self, cached):
+        if cached is not None and cached[0] == self._INVALID_INDICATOR:
+            self._LOG.debug('Cached Token is marked unauthorized')
+            raise exc.InvalidToken(_('Token authorization failed'))
+        return cached
+
+    def get(self, token_id):
+        """Return token information from cache.
+
+        If token is invalid raise exc.InvalidToken
+        return token only if fresh (not expired).
+        """
+        cached = self.get_with_expiry(token_id)
+        if cached is None:
+            return None
+        return cached[0]
+
+    def get_with_expiry(self, token_id):
+        """Return token information from cache and when it leaves the cache.
+
+        If token is invalid raise exc.InvalidToken
+
+        :returns: A tuple of the token data and the time the cache entry
+                  expires, or None if that is unknown; None if the token is
+                  not cached.
+        """
+
+        if not token_id:
+            # Nothing to do
+            return
+
+        key, context = self._get_cache_key(token_id)
+
+        with self._cache_pool.reserve() as cache:
+            serialized = cache.get(key)
+
+        return self._check_valid(self._decode(serialized, context))
+
+    def get_multi(self, token_ids):
+        """Return the cached information of several tokens.
+
+        The tokens are fetched with a single request where the cache allows
+        it, and one by one otherwise.
+
+        :param list token_ids: The unique token ids.
+
+        :returns: A dict from each token id to what get_with_expiry would
+                  return for it, or to an exc.InvalidToken to raise if the
+                  token is cached as invalid.
+        """
+        contexts = {}
+        for token_id in token_ids:
+            key, context = self._get_cache_key(token_id)
+            contexts[key] = (token_id, context)
+
+        with self._cache_pool.reserve() as cache:
+            get_multi = getattr(cache, 'get_multi', None)
+            if self._use_get_multi and get_multi is not None:
+                found = get_multi(list(contexts))
+            else:
+                found = dict((key, cache.get(key)) for key in contexts)
+
+        results = {}
+        for key, (token_id, context) in six.iteritems(contexts):
+            try:
+                results[token_id] = self._check_valid(
+                    self._decode(found.get(key), context))
+            except exc.InvalidToken as e:
+                results[token_id] = e
+        return results
+
+    def _cache_store(self, token_id, data):
+        """Store value into memcache.
+
+        data may be _INVALID_INDICATOR or a tuple like (data, expires)
+
+        """
+        data = jsonutils.dumps(data)
+        if isinstance(data, six.text_type):
+            data = data.encode('utf-8')
+
+        cache_key, context = self._get_cache_key(token_id)
+        data_to_store = self._serialize(data, context)
+
+        with self._cache_pool.reserve() as cache:
+            cache.set(cache_key, data_to_store, time=self._cache_time)
+
+
+class SecureTokenCache(TokenCache):
+    """A token cache that stores tokens encrypted.
+
+    A more secure version of TokenCache that will encrypt tokens before
+    caching them.
+    """
+
+    def __init__(self, log, security_strategy, secret_key, **kwargs):
+        super(SecureTokenCache, self).__init__(log, **kwargs)
+
+        security_strategy = security_strategy.upper()
+
+        if security_strategy not in ('MAC', 'ENCRYPT'):
+            msg = _('memcache_security_strategy must be ENCRYPT or MAC')
+            raise exc.ConfigurationError(msg)
+        if not secret_key:
+            msg = _('memcache_secret_key must be defined when a '
+                    'memcache_security_strategy is defined')
+            raise exc.ConfigurationError(msg)
+
+        if isinstance(security_strategy, six.string_types):
+            security_strategy = security_strategy.encode('utf-8')
+        if isinstance(secret_key, six.string_types):
+            secret_key = secret_key.encode('utf-8')
+
+        self._security_strategy = security_strategy
+        self._secret_key = secret_key
+
+    def _get_cache_key(self, token_id):
+        context = memcache_crypt.derive_keys(token_id,
+                                             self._secret_key,
+                                             self._security_strategy)
+        key = self._CACHE_KEY_TEMPLATE % memcache_crypt.get_cache_key(context)
+        return key, context
+
+    def _deserialize(self, data, context):
+        try:
+            # unprotect_data will return None if raw_cached is None
+            return memcache_crypt.unprotect_data(context, data)
+        except Exception:
+            msg = _LE('Failed to decrypt/verify cache data')
+            self._LOG.exception(msg)
+
+        # this should have the same effect as data not
+        # found in cache
+        return None
+
+    def _serialize(self, data, context):
+        return memcache_crypt.protect_data(context, data)
+
+
+class LRUCache(object):
+    """A bounded in-process cache with least recently used eviction.
+
+    Every entry carries its own expiry time after which it is treated as
+    absent. Operations are serialized by a lock, which is a greenthread lock
+    when eventlet has monkeypatched threading.
+    """
+
+    def __init__(self, maxsize):
+        self._maxsize = maxsize
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                return None
+            if item[1] <= time.time():
+                return None
+            self._data[key] = item
+            return item[0]
+
+    def set(self, key, value, ttl):
+        if ttl <= 0:
+            self.pop(key)
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time.time() + ttl)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return item[0] if item else None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def items(self):
+        """Return (key, value, expires_at) for the unexpired entries."""
+        now = time.time()
+        with self._lock:
+            return [(key, item[0], item[1])
+                    for key, item in six.iteritems(self._data)
+                    if item[1] > now]
+
+
+class ShardedLRUCache(object):
+    """An LRUCache split into shards, each with its own lock.
+
+    Keys are spread over the shards by their hash, so threads working on
+    different tokens rarely wait for the same lock. Eviction is least
+    recently used within each shard, which approximates it across the
+    whole cache.
+
+    :param int maxsize: the number of entries kept across all shards
+    :param int shards: the number of shards, no more than maxsize are used
+    """
+
+    def __init__(self, maxsize, shards):
+        shards = max(min(shards, maxsize), 1)
+        size, extra = divmod(maxsize, shards)
+        # NOTE: the first extra shards hold one more entry, so that the
+        # shards together hold exactly maxsize.
+        self._shards = tuple(LRUCache(size + (i < extra))
+                             for i in range(shards))
+
+    def _shard(self, key):
+        return self._shards[hash(key) % len(self._shards)]
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards)
+
+    def get(self, key):
+        return self._shard(key).get(key)
+
+    def set(self, key, value, ttl):
+        self._shard(key).set(key, value, ttl)
+
+    def pop(self, key):
+        return self._shard(key).pop(key)
+
+    def clear(self):
+        for shard in self._shards:
+            shard.clear()
+
+    def items(self):
+        """Return (key, value, expires_at) for the unexpired entries."""
+        result = []
+        for shard in self._shards:
+            result.extend(shard.items())
+        return result
+
+
+def lru_cache(maxsize, shards=1):
+    """Return an LRUCache, or a ShardedLRUCache for more than one shard."""
+    if shards > 1:
+        return ShardedLRUCache(maxsize, shards)
+    return LRUCache(maxsize)
+
+
+class BloomFilter(object):
+    """A fixed size Bloom filter of strings.
+
+    :param int capacity: the number of items the filter is sized for
+    :param float error_rate: the false positive rate at capacity
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        capacity = max(capacity, 1)
+        self._size = int(math.ceil(-capacity * math.log(error_rate) /
+                                   math.log(2) ** 2))
+        self._hashes = max(1, int(round(self._size / float(capacity) *
+                                        math.log(2))))
+        self._bits = bytearray((self._size + 7) // 8)
+
+    def _positions(self, item):
+        if isinstance(item, six.text_type):
+            item = item.encode('utf-8')
+        digest = hashlib.md5(item).hexdigest()
+        # NOTE: double hashing derives all the positions from one digest.
+        h1 = int(digest[:16], 16)
+        h2 = int(digest[16:], 16) | 1
+        return ((h1 + i * h2) % self._size for i in range(self._hashes))
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        bits = self._bits
+        return all(bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(item))
+
+
+class RejectedTokens(object):
+    """Remember recently rejected token hashes in bounded memory.
+
+    Hashes are added to the newer of two Bloom filters. Once it has taken
+    capacity hashes or is older than period seconds it becomes the older
+    filter and the previous older one is dropped.
+
+    The filters are sized for a false positive rate low enough that a valid
+    token is practically never mistaken for a rejected one.
+    """
+
+    _ERROR_RATE = 1e-6
+
+    def __init__(self, capacity, period):
+        self._capacity = capacity
+        self._period = period
+        self._lock = threading.Lock()
+        self._generations = (BloomFilter(capacity, self._ERROR_RATE),
+                             BloomFilter(1, self._ERROR_RATE))
+        self._count = 0
+        self._started = time.time()
+
+    def add(self, token_hash):
+        with self._lock:
+            now = time.time()
+            if (self._count >= self._capacity or
+                    now - self._started > self._period):
+                self._generations = (BloomFilter(self._capacity,
+                                                  self._ERROR_RATE),
+                                     self._generations[0])
+                self._count = 0
+                self._started = now
+            self._generations[0].add(token_hash)
+            self._count += 1
+
+    def __contains__(self, token_hash):
+        return any(token_hash in generation
+                   for generation in self._generations)
+
+
+class AdaptiveTTL(object):
+    """Decide how long to cache a token from its expiry and revocations.
+
+    Tokens are cached for at most max_ttl seconds and never past their
+    expiry. The rate at which tokens are revoked is averaged with an
+    exponential decay over period seconds; while more than one token is
+    revoked per max_ttl seconds, the time shrinks to the mean time between
+    revocations, but not below min_ttl, and it grows back as revocations
+    become rare.
+
+    :param int min_ttl: the shortest time to cache a token for
+    :param int max_ttl: the longest time to cache a token for
+    :param int period: seconds over which revocations are averaged
+    """
+
+    def __init__(self, min_ttl, max_ttl, period=600):
+        self._min_ttl = min(min_ttl, max_ttl)
+        self._max_ttl = max_ttl
+        self._period = float(period)
+        self._lock = threading.Lock()
+        # NOTE: (revocations per second, time of the estimate) replaced as
+        # a single reference so that readers need no lock.
+        self._rate = None
+
+    def _decayed(self, now):
+        rate, updated = self._rate
+        return rate * math.exp((updated - now) / self._period)
+
+    def revoked(self, count):
+        """Count tokens that have just been found revoked."""
+        now = time.time()
+        with self._lock:
+            if self._rate is None:
+                # NOTE: the first revocation list holds everything revoked so
+                # far, which says nothing about how often that happens.
+                self._rate = (0.0, now)
+                return
+            self._rate = (self._decayed(now) + count / self._period, now)
+
+    def limit(self):
+        """Return the longest time any token may stay cached right now."""
+        if self._rate is None:
+            return self._max_ttl
+        rate = self._decayed(time.time())
+        if rate * self._max_ttl <= 1:
+            return self._max_ttl
+        return max(1 / rate, self._min_ttl)
+
+    def ttl(self, expires_at):
+        """Return the seconds to cache a token expiring at expires_at."""
+        return min(self.limit(), expires_at - time.time())
@@ -0,0 +1,307 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import base64
+import datetime
+import os
+import re
+import threading
+
+try:
+    from asn1crypto import cms as asn1_cms
+    from cryptography import exceptions as crypto_exceptions
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.hazmat.primitives.asymmetric import padding
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.hazmat.primitives import hashes
+    from cryptography import x509
+except ImportError:
+    asn1_cms = None
+else:
+    # NOTE: only known to newer releases of cryptography.
+    _RSASSA_PSS_OID = x509.ObjectIdentifier('1.2.840.113549.1.1.10')
+    _ANY_EXTENDED_KEY_USAGE_OID = x509.ObjectIdentifier('2.5.29.37.0')
+
+from keystoneclient import exceptions
+import six
+
+
+def is_available():
+    """Return whether the libraries needed to verify CMS data are installed."""
+    return asn1_cms is not None
+
+
+class UnsupportedCMS(Exception):
+    """Raised for CMS data that only openssl can verify."""
+
+
+class CMSVerifier(object):
+    """Verify CMS signed data in-process.
+
+    This is equivalent to ``openssl cms -verify -nocerts`` with the signing
+    and CA certificates from the signing directory, without forking a
+    process per verification: the signer must be allowed to sign S/MIME
+    and every issuer in its chain to issue certificates. The certificates
+    are parsed once and parsed again only when the files change on disk.
+
+    :raises keystoneclient.exceptions.CertificateConfigError: if the
+        certificate files are missing or unreadable.
+    :raises keystoneclient.exceptions.CMSError: if the data is not validly
+        signed by a trusted signing certificate.
+    :raises UnsupportedCMS: if the data uses a feature this verifier does
+        not implement and openssl should be asked instead.
+    """
+
+    _PEM_RE = re.compile(
+        b'-----BEGIN ([A-Z0-9 ]+)-----(.+?)-----END \\1-----', re.DOTALL)
+
+    # NOTE: the depth openssl allows for certificate chains by default
+    _MAX_CHAIN_DEPTH = 9
+
+    def __init__(self, signing_cert_path, ca_path):
+        self._signing_cert_path = signing_cert_path
+        self._ca_path = ca_path
+        self._lock = threading.Lock()
+        self._certs = None
+
+    @classmethod
+    def _pem_blocks(cls, data, label):
+        return [base64.b64decode(body)
+                for name, body in cls._PEM_RE.findall(data)
+                if name == label]
+
+    def _read_certs(self, path):
+        try:
+            with open(path, 'rb') as f:
+                blocks = self._pem_blocks(f.read(), b'CERTIFICATE')
+            certs = [x509.load_der_x509_certificate(der, default_backend())
+                     for der in blocks]
+        except (IOError, OSError, ValueError) as e:
+            raise exceptions.CertificateConfigError(six.text_type(e))
+        if not certs:
+            raise exceptions.CertificateConfigError(
+                'No certificate found in %s' % path)
+        return certs
+
+    def _load_certs(self):
+        """Return the signing and CA certificates, reloading if changed."""
+        try:
+            stamp = tuple((st.st_mtime, st.st_size) for st in
+                          (os.stat(self._signing_cert_path),
+                           os.stat(self._ca_path)))
+        except OSError as e:
+            raise exceptions.CertificateConfigError(six.text_type(e))
+
+        certs = self._certs
+        if certs is None or certs[0] != stamp:
+            with self._lock:
+                certs = self._certs
+                if certs is None or certs[0] != stamp:
+                    certs = (stamp,
+                             self._read_certs(self._signing_cert_path),
+                             self._read_certs(self._ca_path))
+                    self._certs = certs
+        return certs[1], certs[2]
+
+    @staticmethod
+    def _hash(name):
+        try:
+            return getattr(hashes, name.upper())()
+        except (AttributeError, TypeError):
+            raise UnsupportedCMS('digest %s' % name)
+
+    def _verify_signature(self, public_key, signature, data, hash_algorithm,
+                          signature_algo):
+        try:
+            if (signature_algo == 'rsassa_pkcs1v15' and
+                    isinstance(public_key, rsa.RSAPublicKey)):
+                public_key.verify(signature, data, padding.PKCS1v15(),
+                                  hash_algorithm)
+            elif (signature_algo == 'ecdsa' and
+                    isinstance(public_key, ec.EllipticCurvePublicKey)):
+                public_key.verify(signature, data, ec.ECDSA(hash_algorithm))
+            else:
+                raise UnsupportedCMS('%s signature with public key %s'
+                                      % (signature_algo, type(public_key)))
+        except crypto_exceptions.InvalidSignature:
+            return False
+        return True
+
+    def _issued_by(self, cert, issuer):
+        if cert.issuer != issuer.subject:
+            return False
+        if cert.signature_algorithm_oid == _RSASSA_PSS_OID:
+            raise UnsupportedCMS('rsassa_pss certificate signature')
+        public_key = issuer.public_key()
+        if isinstance(public_key, ec.EllipticCurvePublicKey):
+            signature_algo = 'ecdsa'
+        else:
+            signature_algo = 'rsassa_pkcs1v15'
+        return self._verify_signature(public_key, cert.signature,
+                                      cert.tbs_certificate_bytes,
+                                      cert.signature_hash_algorithm,
+                                      signature_algo)
+
+    @staticmethod
+    def _extension(cert, extension_class):
+        try:
+            return cert.extensions.get_extension_for_class(
+                extension_class).value
+        except x509.ExtensionNotFound:
+            return None
+
+    def _check_signer(self, cert):
+        """Check that cert may sign S/MIME, as openssl's smimesign purpose."""
+        key_usage = self._extension(cert, x509.KeyUsage)
+        if key_usage is not None and not (key_usage.digital_signature or
+                                          key_usage.content_commitment):
+            raise exceptions.CMSError('unsupported certificate purpose for %s'
+                                      % cert.subject)
+        extended = self._extension(cert, x509.ExtendedKeyUsage)
+        if extended is not None and not (
+                x509.ExtendedKeyUsageOID.EMAIL_PROTECTION in extended or
+                _ANY_EXTENDED_KEY_USAGE_OID in extended):
+            raise exceptions.CMSError('unsupported certificate purpose for %s'
+                                      % cert.subject)
+
+    def _check_ca(self, cert, depth):
+        """Check that cert may issue certificates, depth CAs down the chain.
+
+        As for openssl, a certificate without basicConstraints is only a CA
+        if it is a self-signed version 1 certificate.
+        """
+        constraints = self._extension(cert, x509.BasicConstraints)
+        if constraints is None:
+            is_ca = (cert.version == x509.Version.v1 and
+                     cert.issuer == cert.subject)
+        else:
+            is_ca = constraints.ca
+        if not is_ca:
+            raise exceptions.CMSError('invalid CA certificate %s'
+                                      % cert.subject)
+        key_usage = self._extension(cert, x509.KeyUsage)
+        if key_usage is not None and not key_usage.key_cert_sign:
+            raise exceptions.CMSError('invalid CA certificate %s'
+                                      % cert.subject)
+        if (constraints is not None and
+                constraints.path_length is not None and
+                depth > constraints.path_length):
+            raise exceptions.CMSError('path length constraint exceeded')
+
+    def _verify_chain(self, cert, intermediates, trusted):
+        now = datetime.datetime.utcnow()
+        self._check_signer(cert)
+        for depth in range(self._MAX_CHAIN_DEPTH):
+            if not cert.not_valid_before <= now <= cert.not_valid_after:
+                raise exceptions.CMSError('certificate %s is not valid now'
+                                          % cert.subject)
+            for ca in trusted:
+                if self._issued_by(cert, ca):
+                    if not ca.not_valid_before <= now <= ca.not_valid_after:
+                        raise exceptions.CMSError(
+                            'CA certificate %s is not valid now' % ca.subject)
+                    self._check_ca(ca, depth)
+                    return
+            for issuer in intermediates:
+                if issuer is not cert and self._issued_by(cert, issuer):
+                    self._check_ca(issuer, depth)
+                    cert = issuer
+                    break
+            else:
+                raise exceptions.CMSError(
+                    'unable to get local issuer certificate for %s'
+                    % cert.subject)
+        raise exceptions.CMSError('certificate chain too long')
+
+    @staticmethod
+    def _find_signer(sid, certs):
+        if sid.name == 'issuer_and_serial_number':
+            serial = sid.chosen['serial_number'].native
+            issuer = sid.chosen['issuer'].dump()
+            for cert in certs:
+                if (cert.serial_number == serial and
+                        cert.issuer.public_bytes(default_backend()) ==
+                        issuer):
+                    return cert
+        elif sid.name == 'subject_key_identifier':
+            for cert in certs:
+                try:
+                    ski = cert.extensions.get_extension_for_class(
+                        x509.SubjectKeyIdentifier).value.digest
+                except x509.ExtensionNotFound:
+                    continue
+                if ski == sid.chosen.native:
+                    return cert
+        raise exceptions.CMSError('signer certificate not found')
+
+    def verify(self, data):
+        """Verify PEM or DER encoded CMS data and return its content."""
+        if isinstance(data, six.text_type):
+            data = data.encode('utf-8')
+        if data.lstrip().startswith(b'-----BEGIN'):
+            blocks = self._pem_blocks(data, b'CMS')
+            if not blocks:
+                raise exceptions.CMSError('no CMS data found')
+            data = blocks[0]
+
+        signing_certs, ca_certs = self._load_certs()
+
+        try:
+            signed_data = asn1_cms.ContentInfo.load(data)['content']
+            content = signed_data['encap_content_info']['content'].native
+            signer_infos = signed_data['signer_infos']
+            if len(signer_infos) != 1:
+                raise UnsupportedCMS('%d signers' % len(signer_infos))
+            signer_info = signer_infos[0]
+            sid = signer_info['sid']
+            digest_name = signer_info['digest_algorithm']['algorithm'].native
+            signature_algorithm = signer_info['signature_algorithm']
+            signature = signer_info['signature'].native
+            signed_attrs = signer_info['signed_attrs']
+            content_type = (
+                signed_data['encap_content_info']['content_type'].native)
+        except (ValueError, KeyError, TypeError) as e:
+            raise exceptions.CMSError(six.text_type(e))
+
+        if content is None:
+            raise exceptions.CMSError('detached content')
+        hash_algorithm = self._hash(digest_name)
+        try:
+            signature_algo = signature_algorithm.signature_algo
+        except ValueError:
+            raise UnsupportedCMS('signature algorithm %s'
+                                  % signature_algorithm['algorithm'].dotted)
+
+        if len(signed_attrs):
+            # NOTE: with signed attributes the signature covers their DER
+            # encoding, and the content is bound by its digest and content
+            # type attributes.
+            digest = hashes.Hash(hash_algorithm, default_backend())
+            digest.update(content)
+            values = dict((attr['type'].native,
+                           [value.native for value in attr['values']])
+                          for attr in signed_attrs)
+            if values.get('message_digest') != [digest.finalize()]:
+                raise exceptions.CMSError('message digest mismatch')
+            if values.get('content_type') != [content_type]:
+                raise exceptions.CMSError('content type mismatch')
+            signed = signed_attrs.untag().dump()
+        else:
+            signed = content
+
+        signer = self._find_signer(sid, signing_certs)
+        if not self._verify_signature(signer.public_key(), signature, signed,
+                                      hash_algorithm, signature_algo):
+            raise exceptions.CMSError('signature verification failure')
+        self._verify_chain(signer, signing_certs, ca_certs)
+        return content
@@ -22,6 +22,10 @@ __all__ = [
     'RemoteError',
 ]
 
+import collections
+import threading
+import time
+
 from oslo_config import cfg
 import six
 import tomograph
@@ -164,6 +168,13 @@ class _CallContext(object):
         if self.version_cap:
             self._check_version_cap(msg.get('version'))
 
+        if timeout is not None:
+            # NOTE: an absolute deadline lets the server skip requests which
+            # we will have stopped waiting for by the time they are handled.
+            # The driver only starts waiting once the message is published,
+            # so servers allow some grace past it for a slow publish.
+            msg['deadline'] = time.time() + timeout
+
         try:
             result = self.transport._send(self.target, msg_ctxt, msg,
                                           wait_for_reply=True, timeout=timeout,
@@ -317,10 +328,17 @@ class RPCClient(object):
         self.version_cap = version_cap
         self.serializer = serializer or msg_serializer.NoOpSerializer()
 
+        self._prepared = collections.OrderedDict()
+        self._prepared_state = None
+        self._prepared_lock = threading.Lock()
+
         super(RPCClient, self).__init__()
 
     _marker = _CallContext._marker
 
+    # The maximum number of prepared call contexts kept by each client.
+    _PREPARED_CACHE_SIZE = 32
+
     def prepare(self, exchange=_marker, topic=_marker, namespace=_marker,
                 version=_marker, server=_marker, fanout=_marker,
                 timeout=_marker, version_cap=_marker, retry=_marker):
@@ -354,11 +372,44 @@ class RPCClient(object):
                       0 means no retry
                       N means N retries
         :type retry: int
+
+        Call contexts are cached per distinct set of arguments, so callers
+        must not modify the returned context or its target. The cache is
+        dropped whenever one of the client's own attributes is reassigned,
+        but changes made to the client's target in place are not noticed.
         """
-        return _CallContext._prepare(self,
-                                     exchange, topic, namespace,
-                                     version, server, fanout,
-                                     timeout, version_cap, retry)
+        key = (exchange, topic, namespace, version, server, fanout,
+               timeout, version_cap, retry)
+        state = (self.transport, self.target, self.serializer,
+                 self.timeout, self.version_cap, self.retry)
+
+        try:
+            with self._prepared_lock:
+                if (self._prepared_state is None or
+                        any(a is not b for a, b in
+                            zip(state, self._prepared_state))):
+                    self._prepared.clear()
+                    self._prepared_state = state
+                state = self._prepared_state
+                cctxt = self._prepared.pop(key, None)
+                if cctxt is not None:
+                    self._prepared[key] = cctxt
+                    return cctxt
+        except TypeError:
+            # NOTE: unhashable arguments can't be cached
+            key = None
+
+        cctxt = _CallContext._prepare(self,
+                                      exchange, topic, namespace,
+                                      version, server, fanout,
+                                      timeout, version_cap, retry)
+        if key is not None:
+            with self._prepared_lock:
+                if self._prepared_state is state:
+                    self._prepared[key] = cctxt
+                    while len(self._prepared) > self._PREPARED_CACHE_SIZE:
+                        self._prepared.popitem(last=False)
+        return cctxt
 
     def cast(self, ctxt, method, **kwargs):
         """Invoke a method and return immediately.
@@ -405,6 +456,11 @@ class RPCClient(object):
         allowed_remote_exmods list, then a messaging.RemoteError exception is
         raised with all details of the remote exception.
 
+        The call timeout is also sent along as an absolute deadline. Servers
+        drop calls whose deadline has passed by more than a grace period
+        before they are dispatched, and endpoints can check the time left
+        with dispatcher.remaining_time().
+
         :param ctxt: a request context dict
         :type ctxt: dict
         :param method: the method name
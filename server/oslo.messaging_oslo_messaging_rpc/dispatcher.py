@@ -17,15 +17,23 @@
 #    under the License.
 
 __all__ = [
+    'DeadlineExpired',
+    'DispatcherMetrics',
     'NoSuchMethod',
+    'PriorityRPCDispatcher',
     'RPCDispatcher',
     'RPCDispatcherError',
     'UnsupportedVersion',
     'ExpectedException',
+    'remaining_time',
 ]
 
+import bisect
+import collections
 import logging
 import sys
+import threading
+import time
 
 import six
 
@@ -40,6 +48,26 @@ import pdb
 
 LOG = logging.getLogger(__name__)
 
+_local = threading.local()
+
+
+def remaining_time():
+    """Return the seconds left before the caller of this RPC gives up.
+
+    Endpoint methods may use this to bound the work they do on behalf of a
+    call. It returns None outside of a dispatch, for casts and for messages
+    from clients which do not send a deadline. The result may be negative
+    once the deadline has passed, and the caller may wait a little longer
+    than it says if publishing the call was slow.
+
+    Deadlines are absolute timestamps, so this relies on the clocks of the
+    client and server hosts being synchronized.
+    """
+    deadline = getattr(_local, 'deadline', None)
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
 
 class ExpectedException(Exception):
     """Encapsulates an expected exception raised by an RPC endpoint
@@ -65,6 +93,17 @@ class NoSuchMethod(RPCDispatcherError, AttributeError):
         self.method = method
 
 
+class DeadlineExpired(RPCDispatcherError):
+    "Raised if the caller stopped waiting before the message was dispatched."
+
+    def __init__(self, method, deadline):
+        msg = ("Deadline of RPC method %s expired %.3f seconds ago" %
+               (method, time.time() - deadline))
+        super(DeadlineExpired, self).__init__(msg)
+        self.method = method
+        self.deadline = deadline
+
+
 class UnsupportedVersion(RPCDispatcherError):
     "Raised if there is no endpoint which supports the requested version."
 
@@ -77,6 +116,124 @@ class UnsupportedVersion(RPCDispatcherError):
         self.method = method
 
 
+class _MethodStats(object):
+    __slots__ = ('calls', 'errors', 'expected', 'in_flight', 'total_time',
+                 'max_time', 'histogram')
+
+    def __init__(self, buckets):
+        self.calls = 0
+        self.errors = 0
+        self.expected = 0
+        self.in_flight = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        # NOTE: one slot per bucket plus a final overflow slot
+        self.histogram = [0] * (len(buckets) + 1)
+
+
+class DispatcherMetrics(object):
+    """Per endpoint method call counters and latency histograms.
+
+    Statistics are keyed by (endpoint class name, method name) and count
+    calls, unexpected errors, ExpectedExceptions, calls in flight and a
+    histogram of dispatch latencies. Updating them costs a lock and a few
+    integer operations per message, independently of whether tracing is
+    enabled.
+
+    Use snapshot() to pull the current values. If dump_interval is set, the
+    statistics are also logged at most once per interval, piggybacking on
+    message dispatch so no timer thread is needed.
+    """
+
+    # Upper bounds of the latency buckets, in seconds.
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, dump_interval=None, log=LOG):
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._dump_interval = dump_interval
+        self._last_dump = time.time()
+        self._log = log
+
+    def start(self, key):
+        """Record the start of a dispatch and return its start time."""
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = _MethodStats(self.BUCKETS)
+            stats.calls += 1
+            stats.in_flight += 1
+        return time.time()
+
+    def finish(self, key, started, error=False, expected=False):
+        """Record the end of a dispatch started at the given time."""
+        now = time.time()
+        elapsed = now - started
+        with self._lock:
+            stats = self._stats[key]
+            stats.in_flight -= 1
+            if expected:
+                stats.expected += 1
+            elif error:
+                stats.errors += 1
+            stats.total_time += elapsed
+            if elapsed > stats.max_time:
+                stats.max_time = elapsed
+            stats.histogram[bisect.bisect_left(self.BUCKETS, elapsed)] += 1
+
+            dump = (self._dump_interval is not None and
+                    now - self._last_dump >= self._dump_interval)
+            if dump:
+                self._last_dump = now
+        if dump:
+            self.dump()
+
+    def snapshot(self):
+        """Return a copy of the statistics.
+
+        :returns: a dict mapping (endpoint class, method) to a dict of
+                  calls, errors, expected, in_flight, total_time, max_time
+                  and histogram, a list of (upper bound, count) pairs whose
+                  last upper bound is None.
+        """
+        bounds = list(self.BUCKETS) + [None]
+        with self._lock:
+            return dict(
+                (key, dict(calls=stats.calls,
+                           errors=stats.errors,
+                           expected=stats.expected,
+                           in_flight=stats.in_flight,
+                           total_time=stats.total_time,
+                           max_time=stats.max_time,
+                           histogram=list(zip(bounds, stats.histogram))))
+                for key, stats in six.iteritems(self._stats))
+
+    def reset(self):
+        """Forget all statistics except the calls currently in flight."""
+        with self._lock:
+            for key, stats in list(six.iteritems(self._stats)):
+                in_flight = stats.in_flight
+                stats = self._stats[key] = _MethodStats(self.BUCKETS)
+                stats.in_flight = in_flight
+
+    def dump(self):
+        """Log the statistics, one line per endpoint method."""
+        for (endpoint, method), stats in sorted(
+                six.iteritems(self.snapshot())):
+            calls = stats['calls'] - stats['in_flight']
+            average = stats['total_time'] / calls if calls else 0.0
+            self._log.info('RPC %(endpoint)s.%(method)s: calls=%(calls)d '
+                           'errors=%(errors)d expected=%(expected)d '
+                           'in_flight=%(in_flight)d avg=%(avg).4fs '
+                           'max=%(max).4fs',
+                           {'endpoint': endpoint, 'method': method,
+                            'calls': stats['calls'],
+                            'errors': stats['errors'],
+                            'expected': stats['expected'],
+                            'in_flight': stats['in_flight'],
+                            'avg': average, 'max': stats['max_time']})
+
+
 class RPCDispatcher(object):
     """A message dispatcher which understands RPC messages.
 
@@ -92,20 +249,40 @@ class RPCDispatcher(object):
     of the methods exposed by that object. All public methods on an endpoint
     object are remotely invokable by clients.
 
+    Per endpoint method call counts and latencies are kept in the metrics
+    attribute, a DispatcherMetrics instance, whether tracing is enabled or
+    not.
 
+    Calls are dropped once their deadline has passed by more than a grace
+    period. Clients stamp the deadline before publishing, but only start
+    waiting for the reply once the message is published, so a slow publish
+    or a reconnection to the broker pushes the time they give up past it.
     """
 
-    def __init__(self, target, endpoints, serializer):
+    DEFAULT_DEADLINE_GRACE = 10
+
+    def __init__(self, target, endpoints, serializer,
+                 metrics_dump_interval=None, deadline_grace=None):
         """Construct a rpc server dispatcher.
 
         :param target: the exchange, topic and server to listen on
         :type target: Target
+        :param metrics_dump_interval: if set, log the dispatch metrics at
+                                      most once per this many seconds
+        :type metrics_dump_interval: int or float
+        :param deadline_grace: seconds past its deadline a call is still
+                               dispatched, DEFAULT_DEADLINE_GRACE if None
+        :type deadline_grace: int or float
         """
 
         self.endpoints = endpoints
         self.serializer = serializer or msg_serializer.NoOpSerializer()
         self._default_target = msg_target.Target()
         self._target = target
+        self.metrics = DispatcherMetrics(dump_interval=metrics_dump_interval)
+        if deadline_grace is None:
+            deadline_grace = self.DEFAULT_DEADLINE_GRACE
+        self._deadline_grace = deadline_grace
 
     def _listen(self, transport):
         return transport._listen(self._target)
@@ -159,6 +336,10 @@ class RPCDispatcher(object):
             LOG.debug(u'Expected exception during message handling (%s)',
                       e.exc_info[1])
             incoming.reply(failure=e.exc_info, log_failure=False)
+        except DeadlineExpired as e:
+            # NOTE: the caller has already timed out, so nobody is waiting
+            # for a reply.
+            LOG.debug(u'Dropping message: %s', e)
         except Exception as e:
             # sys.exc_info() is deleted by LOG.exception().
             exc_info = sys.exc_info()
@@ -177,12 +358,17 @@ class RPCDispatcher(object):
         :type ctxt: dict
         :param message: the message payload
         :type message: dict
-        :raises: NoSuchMethod, UnsupportedVersion
+        :raises: NoSuchMethod, UnsupportedVersion, DeadlineExpired
         """
         method = message.get('method')
         args = message.get('args', {})
         namespace = message.get('namespace')
         version = message.get('version', '1.0')
+        deadline = message.get('deadline')
+
+        if (deadline is not None and
+                deadline + self._deadline_grace <= time.time()):
+            raise DeadlineExpired(method, deadline)
 
         found_compatible = False
         for endpoint in self.endpoints:
@@ -196,10 +382,22 @@ class RPCDispatcher(object):
 
             if hasattr(endpoint, method):
                 localcontext._set_local_context(ctxt)
+                _local.deadline = deadline
+                key = (endpoint.__class__.__name__, method)
+                started = self.metrics.start(key)
+                error = expected = False
                 try:
                     return self._do_dispatch(endpoint, method, ctxt, args,
                                              executor_callback)
+                except ExpectedException:
+                    expected = True
+                    raise
+                except Exception:
+                    error = True
+                    raise
                 finally:
+                    self.metrics.finish(key, started, error, expected)
+                    _local.deadline = None
                     localcontext._clear_local_context()
 
             found_compatible = True
@@ -208,3 +406,165 @@ class RPCDispatcher(object):
             raise NoSuchMethod(method)
         else:
             raise UnsupportedVersion(version, method=method)
+
+
+class PriorityRPCDispatcher(RPCDispatcher):
+    """An RPC dispatcher which serves messages from weighted priority lanes.
+
+    Every incoming message is classified into one of a number of lanes, each
+    of which is a bounded queue. A fixed pool of worker threads pulls
+    messages from the lanes using weighted round-robin scheduling, so that
+    cheap and urgent methods - health checks, heartbeats - are not stuck
+    behind a burst of long-running dispatches.
+
+    A message is classified by the ``priority`` field of the message, if it
+    names a known lane, and otherwise by looking its method up in
+    ``priority_methods``. Anything else goes to the last lane.
+
+    When a lane is full, the executor blocks until a worker frees a slot, so
+    back-pressure is applied to the transport rather than to memory.
+    """
+
+    DEFAULT_LANES = (('high', 4, 100), ('normal', 1, 1000))
+
+    def __init__(self, target, endpoints, serializer, lanes=None,
+                 priority_methods=None, workers=4,
+                 metrics_dump_interval=None, deadline_grace=None):
+        """Construct a priority-aware rpc server dispatcher.
+
+        :param target: the exchange, topic and server to listen on
+        :type target: Target
+        :param lanes: (name, weight, maxsize) tuples, most urgent first
+        :type lanes: list
+        :param priority_methods: a mapping of method name to lane name
+        :type priority_methods: dict
+        :param workers: the number of threads dispatching from the lanes
+        :type workers: int
+        """
+        super(PriorityRPCDispatcher, self).__init__(
+            target, endpoints, serializer,
+            metrics_dump_interval=metrics_dump_interval,
+            deadline_grace=deadline_grace)
+        lanes = lanes or self.DEFAULT_LANES
+        self._lanes = collections.OrderedDict()
+        for name, weight, maxsize in lanes:
+            if weight < 1 or maxsize < 1:
+                raise ValueError("Lane %s needs a positive weight and size"
+                                 % name)
+            self._lanes[name] = collections.deque()
+        self._maxsize = dict((name, maxsize) for name, _, maxsize in lanes)
+        self._default_lane = list(self._lanes)[-1]
+        self._priority_methods = dict(priority_methods or {})
+        for method, lane in six.iteritems(self._priority_methods):
+            if lane not in self._lanes:
+                raise ValueError("Method %s mapped to unknown lane %s"
+                                 % (method, lane))
+
+        # NOTE: the schedule interleaves lanes by weight, e.g. weights 4 and 1
+        # give [high, high, high, high, normal]; empty lanes are skipped.
+        self._schedule = [name for name, weight, _ in lanes
+                          for _ in range(weight)]
+        self._position = 0
+
+        self._workers_count = workers
+        self._workers = []
+        self._running = False
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+    def _listen(self, transport):
+        self._start_workers()
+        return super(PriorityRPCDispatcher, self)._listen(transport)
+
+    def _start_workers(self):
+        with self._lock:
+            if self._running:
+                return
+            previous = self._workers
+        # NOTE: after stop() without wait() the old workers may still be
+        # draining the lanes; let them finish rather than lose track of them.
+        for worker in previous:
+            worker.join()
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+            self._workers = []
+            for _ in range(self._workers_count):
+                worker = threading.Thread(target=self._worker)
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+
+    def stop(self):
+        """Stop accepting messages; workers exit once the lanes drain."""
+        with self._lock:
+            self._running = False
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+
+    def wait(self):
+        """Wait for the workers to finish dispatching queued messages."""
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def lane_depths(self):
+        """Return the number of messages waiting in each lane."""
+        with self._lock:
+            return dict((name, len(queue))
+                        for name, queue in six.iteritems(self._lanes))
+
+    def _classify(self, message):
+        priority = message.get('priority')
+        if priority in self._lanes:
+            return priority
+        return self._priority_methods.get(message.get('method'),
+                                          self._default_lane)
+
+    def __call__(self, incoming, executor_callback=None):
+        incoming.acknowledge()
+        return utils.DispatcherExecutorContext(
+            incoming, self._enqueue,
+            executor_callback=executor_callback)
+
+    def _enqueue(self, incoming, executor_callback):
+        name = self._classify(incoming.message)
+        queue = self._lanes[name]
+        with self._lock:
+            while self._running and len(queue) >= self._maxsize[name]:
+                self._not_full.wait()
+            if self._running:
+                queue.append((incoming, executor_callback))
+                self._not_empty.notify()
+                return
+        # NOTE: nobody is left to drain the lanes, so dispatch inline rather
+        # than dropping an already acknowledged message.
+        self._dispatch_and_reply(incoming, executor_callback)
+
+    def _next_item(self):
+        for _ in range(len(self._schedule)):
+            name = self._schedule[self._position]
+            self._position = (self._position + 1) % len(self._schedule)
+            if self._lanes[name]:
+                return self._lanes[name].popleft()
+        return None
+
+    def _worker(self):
+        while True:
+            with self._lock:
+                item = self._next_item()
+                while item is None:
+                    if not self._running:
+                        return
+                    self._not_empty.wait()
+                    item = self._next_item()
+                self._not_full.notify_all()
+            try:
+                self._dispatch_and_reply(*item)
+            except Exception:
+                # NOTE: a dead worker would leave the lanes to fill up and
+                # block the executor for good, so keep serving.
+                LOG.exception(_LE('Exception while dispatching a message '
+                                  'from a priority lane'))
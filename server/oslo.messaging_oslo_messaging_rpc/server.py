@@ -90,6 +90,7 @@ to - primitive types.
 """
 
 __all__ = [
+    'get_priority_rpc_server',
     'get_rpc_server',
     'expected_exceptions',
 ]
@@ -100,7 +101,8 @@ import tomograph
 
 
 def get_rpc_server(transport, target, endpoints,
-                   executor='blocking', serializer=None):
+                   executor='blocking', serializer=None,
+                   metrics_dump_interval=None, deadline_grace=None):
     """Construct an RPC server.
 
     The executor parameter controls how incoming messages will be received and
@@ -121,11 +123,81 @@ def get_rpc_server(transport, target, endpoints,
     :type executor: str
     :param serializer: an optional entity serializer
     :type serializer: Serializer
+    :param metrics_dump_interval: if set, log the dispatcher metrics at most
+                                  once per this many seconds
+    :type metrics_dump_interval: int or float
+    :param deadline_grace: seconds past its deadline a call is still
+                           dispatched, 10 by default
+    :type deadline_grace: int or float
     """
-    dispatcher = rpc_dispatcher.RPCDispatcher(target, endpoints, serializer)
+    dispatcher = rpc_dispatcher.RPCDispatcher(
+        target, endpoints, serializer,
+        metrics_dump_interval=metrics_dump_interval,
+        deadline_grace=deadline_grace)
     return msg_server.MessageHandlingServer(transport, dispatcher, executor)
 
 
+class _PriorityRPCServer(msg_server.MessageHandlingServer):
+    """A MessageHandlingServer which also drains its dispatcher lanes."""
+
+    def stop(self):
+        super(_PriorityRPCServer, self).stop()
+        self.dispatcher.stop()
+
+    def wait(self):
+        super(_PriorityRPCServer, self).wait()
+        self.dispatcher.wait()
+
+
+def get_priority_rpc_server(transport, target, endpoints,
+                            executor='blocking', serializer=None,
+                            lanes=None, priority_methods=None, workers=4,
+                            metrics_dump_interval=None, deadline_grace=None):
+    """Construct an RPC server which dispatches from weighted priority lanes.
+
+    This behaves like get_rpc_server(), except that incoming messages are
+    classified into bounded lanes and dispatched by a pool of workers which
+    serve the lanes by weight. A message lands in the lane named by its
+    ``priority`` field, or else in the lane its method is mapped to by
+    priority_methods, or else in the last lane. For example::
+
+        server = oslo_messaging.get_priority_rpc_server(
+            transport, target, endpoints, executor='eventlet',
+            lanes=[('high', 4, 100), ('normal', 1, 1000)],
+            priority_methods={'ping': 'high', 'report_state': 'high'})
+
+    :param transport: the messaging transport
+    :type transport: Transport
+    :param target: the exchange, topic and server to listen on
+    :type target: Target
+    :param endpoints: a list of endpoint objects
+    :type endpoints: list
+    :param executor: name of a message executor - for example
+                     'eventlet', 'blocking'
+    :type executor: str
+    :param serializer: an optional entity serializer
+    :type serializer: Serializer
+    :param lanes: (name, weight, maxsize) tuples, most urgent first
+    :type lanes: list
+    :param priority_methods: a mapping of method name to lane name
+    :type priority_methods: dict
+    :param workers: the number of workers dispatching from the lanes
+    :type workers: int
+    :param metrics_dump_interval: if set, log the dispatcher metrics at most
+                                  once per this many seconds
+    :type metrics_dump_interval: int or float
+    :param deadline_grace: seconds past its deadline a call is still
+                           dispatched, 10 by default
+    :type deadline_grace: int or float
+    """
+    dispatcher = rpc_dispatcher.PriorityRPCDispatcher(
+        target, endpoints, serializer, lanes=lanes,
+        priority_methods=priority_methods, workers=workers,
+        metrics_dump_interval=metrics_dump_interval,
+        deadline_grace=deadline_grace)
+    return _PriorityRPCServer(transport, dispatcher, executor)
+
+
 def expected_exceptions(*exceptions):
     """Decorator for RPC endpoint methods that raise expected exceptions.
 
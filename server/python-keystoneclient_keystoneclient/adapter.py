@@ -10,12 +10,215 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import socket
+import threading
+import time
+import weakref
+
 from oslo_serialization import jsonutils
+import requests
+from requests.packages.urllib3 import connectionpool
+from six.moves import urllib
 
 from keystoneclient import utils
 from keystoneclient.session import Session
+from keystoneclient.session import TCPKeepAliveAdapter
 import tomograph
 
+
+_local = threading.local()
+
+
+def _timings():
+    """Return the timings of the Adapter call on this thread, if any."""
+    return getattr(_local, 'timings', None)
+
+
+class _TimedConnectionMixin(object):
+    """Record how long a connection takes to set up and to answer.
+
+    The times are added to the timings of the Adapter call the connection
+    is used for; outside of one the connection behaves as usual. Where
+    urllib3 looks the host name up itself, in releases without the
+    _dns_host attribute, the lookup is timed as part of connecting.
+    """
+
+    def _new_conn(self):
+        timings = _timings()
+        if timings is None:
+            return super(_TimedConnectionMixin, self)._new_conn()
+
+        host = getattr(self, '_dns_host', None)
+        if host is None:
+            started = time.time()
+            try:
+                conn = super(_TimedConnectionMixin, self)._new_conn()
+            finally:
+                timings['connect'] += time.time() - started
+        else:
+            conn = self._resolve_and_connect(host, timings)
+        timings['connections'] += 1
+        return conn
+
+    def _resolve_and_connect(self, host, timings):
+        started = time.time()
+        try:
+            addresses = [info[4][0] for info in socket.getaddrinfo(
+                host, self.port, 0, socket.SOCK_STREAM)]
+        except socket.gaierror:
+            # NOTE: let urllib3 fail the lookup again and raise its error.
+            addresses = [host]
+        resolved = time.time()
+        timings['dns'] += resolved - started
+
+        # NOTE: connect to the resolved addresses in turn, as urllib3 would,
+        # so that the name is not looked up a second time.
+        try:
+            for i, address in enumerate(addresses):
+                self._dns_host = address
+                try:
+                    conn = super(_TimedConnectionMixin, self)._new_conn()
+                    break
+                except Exception:
+                    if i == len(addresses) - 1:
+                        raise
+        finally:
+            self._dns_host = host
+            timings['connect'] += time.time() - resolved
+        return conn
+
+    def getresponse(self, *args, **kwargs):
+        timings = _timings()
+        if timings is None:
+            return super(_TimedConnectionMixin, self).getresponse(*args,
+                                                                  **kwargs)
+        # NOTE: the request has been sent by now, so this is the wait for
+        # the first byte of the response.
+        started = time.time()
+        try:
+            return super(_TimedConnectionMixin, self).getresponse(*args,
+                                                                  **kwargs)
+        finally:
+            timings['ttfb'] += time.time() - started
+            timings['requests'] += 1
+
+
+class _TimedHTTPConnection(_TimedConnectionMixin,
+                           connectionpool.HTTPConnectionPool.ConnectionCls):
+    pass
+
+
+class _TimedHTTPSConnection(_TimedConnectionMixin,
+                            connectionpool.HTTPSConnectionPool.ConnectionCls):
+
+    def connect(self):
+        timings = _timings()
+        if timings is None:
+            return super(_TimedHTTPSConnection, self).connect()
+        started = time.time()
+        before = timings['dns'] + timings['connect']
+        try:
+            return super(_TimedHTTPSConnection, self).connect()
+        finally:
+            # NOTE: whatever connect spent beyond _new_conn went on TLS.
+            elapsed = time.time() - started
+            timings['tls'] += elapsed - (timings['dns'] + timings['connect'] -
+                                         before)
+
+
+class _TimedHTTPConnectionPool(connectionpool.HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(connectionpool.HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+_TIMED_POOL_CLASSES = {
+    'http': _TimedHTTPConnectionPool,
+    'https': _TimedHTTPSConnectionPool,
+}
+
+
+class _TimedHTTPAdapter(TCPKeepAliveAdapter):
+    """A TCPKeepAliveAdapter whose connections record timings."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(_TimedHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = _TIMED_POOL_CLASSES
+
+
+_DEFAULT_ADAPTER_CLASSES = (requests.adapters.HTTPAdapter, TCPKeepAliveAdapter)
+
+_DEFAULT_POOL_CLASSES = {
+    'http': connectionpool.HTTPConnectionPool,
+    'https': connectionpool.HTTPSConnectionPool,
+}
+
+
+def _instrument(requests_session):
+    """Make the adapters of a requests session record timings.
+
+    The adapters a session mounts by default are replaced by timed ones
+    with the same pool settings. Subclasses of TCPKeepAliveAdapter, such as
+    the one auth_token mounts, keep their own behaviour and are given the
+    timed connection pools in place, unless they use pools of their own.
+    Other adapters are left alone. Requests in flight keep the adapter and
+    pool they started with.
+    """
+    for prefix, http_adapter in list(requests_session.adapters.items()):
+        if type(http_adapter) in _DEFAULT_ADAPTER_CLASSES:
+            requests_session.mount(prefix, _TimedHTTPAdapter(
+                pool_connections=http_adapter._pool_connections,
+                pool_maxsize=http_adapter._pool_maxsize,
+                max_retries=http_adapter.max_retries,
+                pool_block=http_adapter._pool_block))
+        elif isinstance(http_adapter, TCPKeepAliveAdapter):
+            manager = http_adapter.poolmanager
+            if manager.pool_classes_by_scheme == _DEFAULT_POOL_CLASSES:
+                manager.pool_classes_by_scheme = _TIMED_POOL_CLASSES
+                # NOTE: pools made before would keep untimed connections.
+                manager.clear()
+
+
+class _EndpointCache(object):
+    """Endpoints found in the service catalogs of auth plugins.
+
+    The endpoint found for an endpoint filter is kept along with the
+    auth_ref it was found in, and ignored once the plugin has a different
+    one, that is once its token has been refreshed or invalidated. The
+    entries of a plugin go away with the plugin.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = weakref.WeakKeyDictionary()
+
+    @staticmethod
+    def _key(endpoint_filter):
+        return tuple(sorted(
+            (name, tuple(value) if isinstance(value, list) else value)
+            for name, value in endpoint_filter.items()))
+
+    def get(self, auth, endpoint_filter):
+        """Return the (auth_ref, endpoint) cached for a filter, or None."""
+        key = self._key(endpoint_filter)
+        with self._lock:
+            return self._endpoints.get(auth, {}).get(key)
+
+    def set(self, auth, auth_ref, endpoint_filter, endpoint):
+        key = self._key(endpoint_filter)
+        with self._lock:
+            self._endpoints.setdefault(auth, {})[key] = (auth_ref, endpoint)
+
+    def invalidate(self, auth):
+        with self._lock:
+            self._endpoints.pop(auth, None)
+
+
+_endpoint_cache = _EndpointCache()
+
+
 class Adapter(object):
     """An instance of a session with local variables.
 
@@ -44,8 +247,22 @@ class Adapter(object):
     :param logger: A logging object to use for requests that pass through this
                    adapter.
     :type logger: logging.Logger
+
+    Requests made through an adapter count the connections they open or
+    reuse and the time spent resolving names, connecting, in TLS handshakes
+    and waiting for the first byte of responses, see
+    :py:meth:`get_connection_stats`. The times of each request are also
+    tagged on its trace span.
+
+    Endpoints are looked up in the service catalog once per auth plugin and
+    endpoint filter, and again only after the token of the plugin has been
+    refreshed or the adapter has been invalidated. A token about to expire
+    is refreshed before the cache is consulted, so that a request is not
+    sent to an endpoint from the catalog being replaced.
     """
 
+    _TIMINGS = ('dns', 'connect', 'tls', 'ttfb')
+
     @utils.positional()
     def __init__(self, session, service_type=None, service_name=None,
                  interface=None, region_name=None, endpoint_override=None,
@@ -64,6 +281,11 @@ class Adapter(object):
         self.auth = auth
         self.connect_retries = connect_retries
         self.logger = logger
+        self._connection_stats = dict.fromkeys(
+            ('calls', 'requests', 'connections') + self._TIMINGS, 0)
+        self._connection_stats_lock = threading.Lock()
+        if isinstance(session, Session):
+            _instrument(session.session)
 
     def _set_endpoint_filter_kwargs(self, kwargs):
         if self.service_type:
@@ -86,6 +308,11 @@ class Adapter(object):
 
         if self.auth:
             kwargs.setdefault('auth', self.auth)
+        if (endpoint_filter and not kwargs.get('endpoint_override') and
+                not urllib.parse.urlparse(url).netloc):
+            endpoint = self._get_endpoint(kwargs.get('auth'), endpoint_filter)
+            if endpoint:
+                kwargs['endpoint_override'] = endpoint
         if self.user_agent:
             kwargs.setdefault('user_agent', self.user_agent)
         if self.connect_retries is not None:
@@ -106,12 +333,51 @@ class Adapter(object):
             ser_name = "%s[%s]" % (span_service_name, span_name)
             tomograph.start_http_h(ser_name, span_name, kwargs["headers"], span_host, 0)
             tomograph.add_trace_info_header(kwargs["headers"])
-            ret = self.session.request(url, method, **kwargs)
+            previous = _timings()
+            timings = _local.timings = dict.fromkeys(
+                ('requests', 'connections') + self._TIMINGS, 0)
+            try:
+                ret = self.session.request(url, method, **kwargs)
+            finally:
+                _local.timings = previous
+                self._record_timings(timings)
             tomograph.stop(span_name)
             return ret
         else:
             return self.session.request(url, method, **kwargs)
 
+    def _record_timings(self, timings):
+        with self._connection_stats_lock:
+            self._connection_stats['calls'] += 1
+            for key, value in timings.items():
+                self._connection_stats[key] += value
+
+        reused = timings['requests'] - timings['connections']
+        tomograph.tag('http.connections.new', str(timings['connections']))
+        tomograph.tag('http.connections.reused', str(max(reused, 0)))
+        for key in self._TIMINGS:
+            if timings[key]:
+                tomograph.tag('http.%s' % key, '%.3fms' % (timings[key] * 1e3))
+
+    def get_connection_stats(self):
+        """Return counts and times of the requests made by this adapter.
+
+        Only requests made with a :py:class:`keystoneclient.session.Session`
+        are counted.
+
+        :returns: A dict with the number of adapter ``calls``, the HTTP
+                  ``requests`` they made including retries and redirects,
+                  the ``connections`` opened for them and the ``reused``
+                  ones, and the total seconds spent on ``dns`` lookups,
+                  ``connect`` and ``tls`` handshakes, and waiting for the
+                  first byte of responses (``ttfb``).
+        :rtype: dict
+        """
+        with self._connection_stats_lock:
+            stats = dict(self._connection_stats)
+        stats['reused'] = max(stats['requests'] - stats['connections'], 0)
+        return stats
+
     def get_token(self, auth=None):
         """Return a token as provided by the auth plugin.
 
@@ -143,10 +409,44 @@ class Adapter(object):
         if self.endpoint_override:
             return self.endpoint_override
         self._set_endpoint_filter_kwargs(kwargs)
-        return self.session.get_endpoint(auth or self.auth, **kwargs)
+        return self._get_endpoint(auth or self.auth, kwargs)
+
+    def _get_endpoint(self, auth, endpoint_filter):
+        """Look up an endpoint, from the cache if it was looked up before."""
+        auth = auth or self.session.auth
+        if auth is None:
+            # NOTE: let the session raise MissingAuthPlugin
+            return self.session.get_endpoint(auth, **endpoint_filter)
+        try:
+            entry = _endpoint_cache.get(auth, endpoint_filter)
+        except TypeError:
+            # NOTE: unhashable filter values or a plugin that cannot be
+            # weakly referenced are not cached.
+            return self.session.get_endpoint(auth, **endpoint_filter)
+        # NOTE: get_access() fetches a new token first if the current one is
+        # about to expire, as the session would when sending the request, so
+        # an endpoint from the catalog being replaced is not used.
+        if entry is not None and entry[0] is auth.get_access(self.session):
+            return entry[1]
+        auth_ref = getattr(auth, 'auth_ref', None)
+        endpoint = self.session.get_endpoint(auth, **endpoint_filter)
+        # NOTE: the lookup itself may fetch a token, so the endpoint is cached
+        # under the auth_ref the plugin had before only if that is unchanged.
+        # Only identity plugins, which have get_access(), are cached.
+        if (endpoint and auth_ref is not None and
+                hasattr(auth, 'get_access') and
+                getattr(auth, 'auth_ref', None) is auth_ref):
+            _endpoint_cache.set(auth, auth_ref, endpoint_filter, endpoint)
+        return endpoint
 
     def invalidate(self, auth=None):
         """Invalidate an authentication plugin."""
+        cached_auth = auth or self.auth or self.session.auth
+        if cached_auth is not None:
+            try:
+                _endpoint_cache.invalidate(cached_auth)
+            except TypeError:
+                pass
         return self.session.invalidate(auth or self.auth)
 
     def get_user_id(self, auth=None):
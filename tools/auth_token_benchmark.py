@@ -0,0 +1,683 @@
+#!/usr/bin/env python
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Load test the patched keystonemiddleware auth_token middleware.
+
+AuthProtocol runs as WSGI middleware in front of a trivial application and
+talks to a fake identity server on a local port, optionally through a
+memcached stand-in on another local port. Client threads send requests
+carrying a mix of UUID, PKI and PKIZ tokens, reusing tokens they have seen
+before at a given hit ratio, so caching strategies can be compared by their
+throughput, latency and the calls they make to keystone and memcached.
+
+Run it on a host where the patched keystonemiddleware, python-memcached and
+openssl are installed::
+
+    python tools/auth_token_benchmark.py --requests 20000 --concurrency 16 \\
+        --mix uuid=80 pki=10 pkiz=10 --hit-ratio 0.95 --memcached \\
+        --save-baseline auth-baseline.json
+
+    # after changing auth_token, or with other middleware options
+    python tools/auth_token_benchmark.py ... --conf memory_cache_size=0 \\
+        --baseline auth-baseline.json
+
+Compared against a baseline, the run fails with exit status 1 if the
+throughput dropped or the p99 latency grew by more than --threshold percent.
+
+With --batch, the middleware validates tokens through the bulk endpoint of
+the fake identity server, and the report counts the tokens it was sent.
+--check-batching only checks that batches are sent, that each request gets
+the result for its own token, and that tokens the endpoint leaves out or
+fails for are validated one at a time; it exits with status 1 otherwise.
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import datetime
+import hashlib
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from keystoneclient.common import cms
+from keystoneclient import fixture
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+import tomograph
+import webob
+
+import benchmark_common
+from keystonemiddleware import auth_token
+
+
+_FORMATS = ('uuid', 'pki', 'pkiz')
+
+
+def _disable_tracing():
+    """Replace the tomograph hooks used by auth_token with no-ops."""
+    for name in ('start_http', 'stop', 'add_trace_info_header', 'tag',
+                 'annotate'):
+        setattr(tomograph, name, lambda *args, **kwargs: None)
+
+
+class _Counter(object):
+    """A thread safe collections.Counter."""
+
+    def __init__(self):
+        self._counts = collections.Counter()
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        with self._lock:
+            self._counts[key] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+    def clear(self):
+        with self._lock:
+            self._counts.clear()
+
+
+class _Signer(object):
+    """A throwaway CA and signing certificate for PKI tokens."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.ca_cert = os.path.join(directory, 'ca.pem')
+        self.signing_cert = os.path.join(directory, 'signing_cert.pem')
+        self.signing_key = os.path.join(directory, 'signing_key.pem')
+        ca_key = os.path.join(directory, 'ca_key.pem')
+        csr = os.path.join(directory, 'signing.csr')
+        for command in (
+                ['req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days',
+                 '2', '-subj', '/CN=benchmark-ca', '-keyout', ca_key,
+                 '-out', self.ca_cert],
+                ['req', '-newkey', 'rsa:2048', '-nodes', '-subj',
+                 '/CN=benchmark-signing', '-keyout', self.signing_key,
+                 '-out', csr],
+                ['x509', '-req', '-days', '2', '-in', csr, '-CA',
+                 self.ca_cert, '-CAkey', ca_key, '-CAcreateserial', '-out',
+                 self.signing_cert]):
+            subprocess.check_call(['openssl'] + command,
+                                  stdout=open(os.devnull, 'w'),
+                                  stderr=subprocess.STDOUT)
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def sign_token(self, text, token_format):
+        if token_format == 'pkiz':
+            return cms.pkiz_sign(text, self.signing_cert, self.signing_key)
+        return cms.cms_to_token(cms.cms_sign_token(text, self.signing_cert,
+                                                   self.signing_key))
+
+    def sign_text(self, text):
+        return cms.cms_sign_text(text, self.signing_cert, self.signing_key)
+
+
+class _TokenFactory(object):
+    """Create tokens of each format along with their validation data."""
+
+    def __init__(self, signer, catalog_size):
+        self._signer = signer
+        self._catalog_size = catalog_size
+        # token id or hash -> token data, as the identity server knows them
+        self.tokens = {}
+
+    def _token_data(self):
+        token = fixture.V3Token(
+            expires=datetime.datetime.utcnow() + datetime.timedelta(hours=1),
+            user_id=uuid.uuid4().hex, user_name='bench',
+            user_domain_id='default')
+        token.set_project_scope(name='bench', domain_id='default')
+        token.add_role(name='member')
+        for i in range(self._catalog_size):
+            service = token.add_service('service%d' % i, name='svc%d' % i)
+            service.add_standard_endpoints(
+                public='http://public.example.com/%d' % i,
+                internal='http://internal.example.com/%d' % i,
+                admin='http://admin.example.com/%d' % i,
+                region='RegionOne')
+        return token
+
+    def create(self, token_format):
+        data = self._token_data()
+        if token_format == 'uuid':
+            token_id = uuid.uuid4().hex
+        else:
+            token_id = self._signer.sign_token(json.dumps(data),
+                                               token_format)
+        self.tokens[token_id] = data
+        return token_id
+
+
+class _FakeIdentityServer(BaseHTTPServer.HTTPServer):
+    """Just enough of the v3 identity API for auth_token."""
+
+    def __init__(self, tokens, signer, revoked_ids):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           _IdentityHandler)
+        self.tokens = tokens
+        self.signer = signer
+        self.revoked_ids = revoked_ids
+        self.calls = _Counter()
+        # NOTE: 'ok' answers for every token of a batch, 'omit' for every
+        # other one and 'fail' for none, with an error.
+        self.batch_mode = 'ok'
+        self._revocation_list = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_port
+
+    def revocation_list(self):
+        if self._revocation_list is None:
+            expires = (datetime.datetime.utcnow() +
+                       datetime.timedelta(hours=1)).isoformat()
+            text = json.dumps({'revoked': [{'id': token_id,
+                                            'expires': expires}
+                                           for token_id in self.revoked_ids]})
+            self._revocation_list = self.signer.sign_text(text)
+        return self._revocation_list
+
+
+class _ThreadingFakeIdentityServer(socketserver.ThreadingMixIn,
+                                   _FakeIdentityServer):
+
+    daemon_threads = True
+
+
+class _IdentityHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body, content_type='application/json',
+               headers=()):
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        path = self.path.split('?')[0].rstrip('/')
+        server.calls.add('GET ' + (path or '/'))
+        if path in ('', '/v3'):
+            self._reply(200, json.dumps({'versions': {'values': [{
+                'id': 'v3.0', 'status': 'stable', 'updated': '2013-03-06',
+                'links': [{'rel': 'self', 'href': server.url + '/v3/'}]}]}}))
+        elif path == '/v3/auth/tokens':
+            token = self.headers.get('X-Subject-Token')
+            data = server.tokens.get(token)
+            if data is None:
+                self._reply(404, '{"error": {"code": 404}}')
+            else:
+                self._reply(200, json.dumps(data),
+                            headers=[('X-Subject-Token', token)])
+        elif path == '/v3/auth/tokens/OS-PKI/revoked':
+            self._reply(200, json.dumps(
+                {'signed': server.revocation_list()}))
+        elif path == '/v3/OS-SIMPLE-CERT/certificates':
+            self._reply(200, server.signer.read(server.signer.signing_cert),
+                        'application/x-pem-file')
+        elif path == '/v3/OS-SIMPLE-CERT/ca':
+            self._reply(200, server.signer.read(server.signer.ca_cert),
+                        'application/x-pem-file')
+        else:
+            self._reply(404, '{"error": {"code": 404}}')
+
+    def do_POST(self):
+        server = self.server
+        path = self.path.split('?')[0].rstrip('/')
+        server.calls.add('POST ' + path)
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length).decode('utf-8'))
+        if path != '/batch':
+            self._reply(404, '{"error": {"code": 404}}')
+            return
+        # NOTE: bulk validation as used by batch_validation_url
+        tokens = body['tokens']
+        answered = tokens
+        if server.batch_mode == 'fail':
+            answered = []
+        elif server.batch_mode == 'omit':
+            answered = tokens[::2]
+        for _token in tokens:
+            server.calls.add('batched tokens')
+        for _token in range(len(tokens) - len(answered)):
+            server.calls.add('unanswered tokens')
+        if server.batch_mode == 'fail':
+            self._reply(500, '{"error": {"code": 500}}')
+            return
+        self._reply(200, json.dumps({'tokens': dict(
+            (token, server.tokens.get(token)) for token in answered)}))
+
+
+class _FakeMemcached(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """An in-memory server speaking enough of the memcached protocol."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        socketserver.TCPServer.__init__(self, ('127.0.0.1', 0),
+                                        _MemcachedHandler)
+        self.data = {}
+        self.lock = threading.Lock()
+        self.calls = _Counter()
+
+    @property
+    def address(self):
+        return '127.0.0.1:%d' % self.server_address[1]
+
+
+class _MemcachedHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        server = self.server
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.split()
+            if not parts:
+                continue
+            command = parts[0].decode('ascii')
+            server.calls.add(command)
+            if command in ('get', 'gets'):
+                now = time.time()
+                out = []
+                with server.lock:
+                    for key in parts[1:]:
+                        item = server.data.get(key)
+                        if item and (not item[2] or item[2] > now):
+                            out.append(b'VALUE ' + key + b' ' + item[0] +
+                                       b' ' + str(len(item[1])).encode() +
+                                       b'\r\n' + item[1] + b'\r\n')
+                self.wfile.write(b''.join(out) + b'END\r\n')
+            elif command in ('set', 'add', 'replace'):
+                key, flags, exptime, length = parts[1:5]
+                value = self.rfile.read(int(length) + 2)[:-2]
+                exptime = int(exptime)
+                expires = time.time() + exptime if exptime else 0
+                with server.lock:
+                    stored = not (command == 'add' and key in server.data or
+                                  command == 'replace' and
+                                  key not in server.data)
+                    if stored:
+                        server.data[key] = (flags, value, expires)
+                if parts[-1] != b'noreply':
+                    self.wfile.write(b'STORED\r\n' if stored
+                                     else b'NOT_STORED\r\n')
+            elif command == 'delete':
+                with server.lock:
+                    found = server.data.pop(parts[1], None) is not None
+                if parts[-1] != b'noreply':
+                    self.wfile.write(b'DELETED\r\n' if found
+                                     else b'NOT_FOUND\r\n')
+            elif command == 'version':
+                self.wfile.write(b'VERSION 1.4.0-benchmark\r\n')
+            else:
+                self.wfile.write(b'ERROR\r\n')
+
+
+def _app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [b'ok']
+
+
+def _user_app(environ, start_response):
+    """Answer with the user id auth_token found for the request."""
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [environ['HTTP_X_USER_ID'].encode('utf-8')]
+
+
+def _start(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def _parse_pairs(pairs, what):
+    result = {}
+    for pair in pairs or ():
+        key, sep, value = pair.partition('=')
+        if not sep:
+            raise SystemExit('%s must look like key=value: %s' % (what, pair))
+        result[key] = value
+    return result
+
+
+class _Workload(object):
+    """Decide which token each request carries.
+
+    Every format gets its own pool of tokens. A request reuses a token it
+    has sent before with probability hit_ratio and otherwise takes a token
+    no request has used yet, so the hit ratio of the middleware caches
+    follows the configured one once they are warm.
+    """
+
+    def __init__(self, tokens_by_format, mix, hit_ratio, seed):
+        self._fresh = dict((fmt, list(tokens))
+                           for fmt, tokens in tokens_by_format.items())
+        self._used = dict((fmt, []) for fmt in tokens_by_format)
+        self._formats = []
+        for fmt, weight in sorted(mix.items()):
+            self._formats.extend([fmt] * weight)
+        self._hit_ratio = hit_ratio
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def next_token(self):
+        with self._lock:
+            fmt = self._random.choice(self._formats)
+            used = self._used[fmt]
+            if used and (self._random.random() < self._hit_ratio or
+                         not self._fresh[fmt]):
+                return fmt, self._random.choice(used)
+            token = self._fresh[fmt].pop()
+            used.append(token)
+            return fmt, token
+
+
+def _needed_tokens(args, mix):
+    """Tokens of each format a run can consume without repeating."""
+    total = sum(mix.values())
+    misses = (args.requests + args.warmup) * (1 - args.hit_ratio)
+    return dict((fmt, int(misses * weight / total) + args.concurrency + 1)
+                for fmt, weight in mix.items())
+
+
+def _run_clients(app, workload, requests, concurrency):
+    latencies = []
+    statuses = _Counter()
+    lock = threading.Lock()
+    remaining = [requests]
+
+    def client():
+        own = []
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    break
+                remaining[0] -= 1
+            fmt, token = workload.next_token()
+            request = webob.Request.blank('/', headers={'X-Auth-Token': token})
+            started = time.time()
+            response = request.get_response(app)
+            own.append(time.time() - started)
+            statuses.add('%s %d' % (fmt, response.status_int))
+        with lock:
+            latencies.extend(own)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - started, latencies, statuses.snapshot()
+
+
+def run(args):
+    if args.tracing == 'off':
+        _disable_tracing()
+
+    mix = dict((fmt, int(weight)) for fmt, weight in
+               _parse_pairs(args.mix, '--mix').items())
+    unknown = set(mix) - set(_FORMATS)
+    if unknown:
+        raise SystemExit('unknown token formats: %s' % ', '.join(unknown))
+    mix = dict((fmt, weight) for fmt, weight in mix.items() if weight > 0)
+
+    workdir = tempfile.mkdtemp(prefix='auth-token-benchmark-')
+    try:
+        signer = _Signer(workdir)
+        factory = _TokenFactory(signer, args.catalog_size)
+        tokens_by_format = dict(
+            (fmt, [factory.create(fmt) for _ in range(count)])
+            for fmt, count in _needed_tokens(args, mix).items())
+
+        rng = random.Random(args.seed)
+        revoked_ids = [hashlib.md5(str(rng.random()).encode()).hexdigest()
+                       for _ in range(args.revoked)]
+        identity = _start(_ThreadingFakeIdentityServer(factory.tokens, signer,
+                                                       revoked_ids))
+
+        conf = {
+            'identity_uri': identity.url,
+            'auth_uri': identity.url,
+            'admin_token': 'benchmark-admin-token',
+            'auth_version': 'v3.0',
+            'signing_dir': os.path.join(workdir, 'signing'),
+            'log_name': 'auth_token_benchmark',
+        }
+        memcached = None
+        if args.memcached:
+            memcached = _start(_FakeMemcached())
+            conf['memcached_servers'] = memcached.address
+        if args.batch:
+            conf['batch_validation_url'] = identity.url + '/batch'
+        conf.update(_parse_pairs(args.conf, '--conf'))
+
+        app = auth_token.AuthProtocol(_app, conf)
+        workload = _Workload(tokens_by_format, mix, args.hit_ratio,
+                             args.seed)
+
+        _run_clients(app, workload, args.warmup, args.concurrency)
+        identity.calls.clear()
+        if memcached:
+            memcached.calls.clear()
+
+        elapsed, latencies, statuses = _run_clients(
+            app, workload, args.requests, args.concurrency)
+        pool = getattr(app, '_identity_pool', None)
+        pool_stats = pool.stats() if pool else None
+
+        identity.shutdown()
+        if memcached:
+            memcached.shutdown()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'config': {
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'mix': mix,
+            'hit_ratio': args.hit_ratio,
+            'revoked': args.revoked,
+            'catalog_size': args.catalog_size,
+            'memcached': args.memcached,
+            'batch': args.batch,
+            'conf': _parse_pairs(args.conf, '--conf'),
+            'tracing': args.tracing,
+            'python': sys.version.split()[0],
+        },
+        'results': {
+            'requests_per_second': args.requests / elapsed,
+            'mean_ms': sum(latencies) / len(latencies) * 1e3,
+            'p50_ms': benchmark_common.percentile(latencies, 0.50) * 1e3,
+            'p99_ms': benchmark_common.percentile(latencies, 0.99) * 1e3,
+            'statuses': statuses,
+            'identity_calls': identity.calls.snapshot(),
+            'memcached_calls': memcached.calls.snapshot() if memcached
+            else None,
+            'identity_pool': pool_stats,
+        },
+    }
+
+
+def _send_together(app, tokens):
+    """Send one request per token at once and return their responses."""
+    responses = {}
+    start = threading.Event()
+
+    def client(token):
+        request = webob.Request.blank('/', headers={'X-Auth-Token': token})
+        start.wait()
+        responses[token] = request.get_response(app)
+
+    threads = [threading.Thread(target=client, args=(token,))
+               for token in tokens]
+    for thread in threads:
+        thread.start()
+    start.set()
+    for thread in threads:
+        thread.join()
+    return responses
+
+
+def check_batching(args):
+    """Check batch validation against the fake identity server.
+
+    Each case sends concurrency requests with new UUID tokens, and one with
+    a token the identity server does not know, to a new middleware.
+
+    :returns: the exit status, 1 if any check failed.
+    """
+    _disable_tracing()
+    factory = _TokenFactory(None, args.catalog_size)
+    identity = _start(_ThreadingFakeIdentityServer(factory.tokens, None, []))
+    conf = {
+        'identity_uri': identity.url,
+        'auth_uri': identity.url,
+        'admin_token': 'benchmark-admin-token',
+        'auth_version': 'v3.0',
+        'log_name': 'auth_token_benchmark',
+        'batch_validation_url': identity.url + '/batch',
+        # NOTE: long enough for every request of a case to join the batch
+        'batch_validation_window': '0.2',
+    }
+    conf.update(_parse_pairs(args.conf, '--conf'))
+
+    failures = []
+
+    def expect(case, what, ok):
+        print('%-6s %-48s %s' % (case, what, 'ok' if ok else 'FAILED'))
+        if not ok:
+            failures.append((case, what))
+
+    try:
+        for mode in ('ok', 'omit', 'fail'):
+            identity.batch_mode = mode
+            tokens = [factory.create('uuid')
+                      for _ in range(args.concurrency)]
+            invalid = uuid.uuid4().hex
+            app = auth_token.AuthProtocol(_user_app, conf)
+            identity.calls.clear()
+            responses = _send_together(app, tokens + [invalid])
+            calls = identity.calls.snapshot()
+
+            expect(mode, 'each token gets its own user',
+                   all(responses[token].status_int == 200 and
+                       responses[token].text ==
+                       factory.tokens[token].user_id
+                       for token in tokens))
+            expect(mode, 'unknown token rejected',
+                   responses[invalid].status_int == 401)
+            expect(mode, 'tokens sent in batches',
+                   calls.get('batched tokens') == len(tokens) + 1 and
+                   calls.get('POST /batch', 0) < len(tokens))
+            # NOTE: exactly the tokens the batches did not answer for, the
+            # unknown one included, are validated alone.
+            unanswered = calls.get('unanswered tokens', 0)
+            expect(mode, '%d unanswered tokens validated alone' % unanswered,
+                   calls.get('GET /v3/auth/tokens', 0) == unanswered and
+                   (mode == 'ok') == (unanswered == 0))
+    finally:
+        identity.shutdown()
+    return 1 if failures else 0
+
+
+def compare(report, baseline, threshold):
+    """Print the changes against a baseline and return the regressions."""
+    # NOTE: a drop in throughput is as bad as a rise in latency
+    regressions = benchmark_common.compare_metrics(
+        'auth_token', report['results'], baseline['results'],
+        (('requests_per_second', -1), ('mean_ms', 1), ('p99_ms', 1)),
+        threshold)
+    for calls in ('identity_calls', 'memcached_calls'):
+        print('%-20s %s -> %s' % (calls, baseline['results'].get(calls),
+                                  report['results'].get(calls)))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--requests', type=benchmark_common.count(1),
+                        default=5000, help='Requests to measure.')
+    parser.add_argument('--warmup', type=benchmark_common.count(0),
+                        default=500,
+                        help='Requests to send before measuring.')
+    parser.add_argument('--concurrency', type=benchmark_common.count(1),
+                        default=8, help='Number of client threads.')
+    parser.add_argument('--mix', nargs='+', metavar='FORMAT=WEIGHT',
+                        default=['uuid=1'],
+                        help='Relative weights of the token formats, out of '
+                             '%s.' % ', '.join(_FORMATS))
+    parser.add_argument('--hit-ratio', type=benchmark_common.fraction,
+                        default=0.9,
+                        help='Fraction of requests reusing a token sent '
+                             'before.')
+    parser.add_argument('--revoked', type=benchmark_common.count(0),
+                        default=100,
+                        help='Entries in the revocation list.')
+    parser.add_argument('--catalog-size', type=benchmark_common.count(0),
+                        default=10,
+                        help='Services in the catalog of each token.')
+    parser.add_argument('--memcached', action='store_true',
+                        help='Cache tokens in a local memcached stand-in '
+                             'instead of in-process.')
+    parser.add_argument('--batch', action='store_true',
+                        help='Validate tokens through the bulk endpoint of '
+                             'the identity server.')
+    parser.add_argument('--check-batching', action='store_true',
+                        help='Only check batch validation, its fan-out and '
+                             'its fallback to single validation.')
+    parser.add_argument('--conf', nargs='+', metavar='OPTION=VALUE',
+                        help='Extra auth_token options, as in paste.ini.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--tracing', choices=('on', 'off'), default='off')
+    benchmark_common.add_baseline_options(parser)
+    args = parser.parse_args(argv)
+
+    if args.check_batching:
+        return check_batching(args)
+    return benchmark_common.finish(run(args), args, compare)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
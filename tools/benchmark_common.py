@@ -0,0 +1,99 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Helpers shared by the benchmarks in this directory.
+
+Each benchmark builds a report of the form {'config': {...}, 'results':
+{...}}, which can be saved as a baseline and compared against one with the
+options added by add_baseline_options().
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+
+
+def count(minimum):
+    """Return an argparse type for integers of at least minimum."""
+    def parse(value):
+        number = int(value)
+        if number < minimum:
+            raise argparse.ArgumentTypeError('must be at least %d' % minimum)
+        return number
+    return parse
+
+
+def fraction(value):
+    """An argparse type for numbers between 0 and 1."""
+    number = float(value)
+    if not 0 <= number <= 1:
+        raise argparse.ArgumentTypeError('must be between 0 and 1')
+    return number
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def add_baseline_options(parser):
+    parser.add_argument('--save-baseline', metavar='FILE',
+                        help='Write the results to FILE.')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='Compare the results against FILE.')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='Allowed slowdown against the baseline, in '
+                             'percent.')
+
+
+def compare_metrics(name, result, previous, metrics, threshold):
+    """Print the changes of one result and return its regressions.
+
+    :param metrics: (metric, sign) pairs, where sign is 1 if the metric
+        gets worse as it grows and -1 if it gets worse as it drops.
+    """
+    regressions = []
+    for metric, sign in metrics:
+        change = (result[metric] - previous[metric]) / previous[metric]
+        print('%-22s %-22s %12.2f -> %12.2f  (%+.1f%%)'
+              % (name, metric, previous[metric], result[metric],
+                 change * 100))
+        if sign * change * 100 > threshold:
+            regressions.append((name, metric, change))
+    return regressions
+
+
+def finish(report, args, compare):
+    """Print and save the report, and compare it against the baseline.
+
+    :param compare: called with the report, the baseline and the threshold
+        to print the changes and return the regressions.
+    :returns: the exit status, 1 if anything regressed.
+    """
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if report['config'] != baseline['config']:
+            print('warning: baseline was recorded with %s'
+                  % baseline['config'])
+        if compare(report, baseline, args.threshold):
+            return 1
+    return 0
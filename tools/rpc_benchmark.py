@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Measure the per-message cost of the patched oslo.messaging RPC path.
+
+Messages go from RPCClient.call()/cast() through the in-memory fake transport
+to RPCDispatcher, which is driven by a single polling thread the same way an
+executor would drive it. Nothing leaves the process, so the numbers are the
+overhead of the client, serializer, dispatcher and tracing code itself.
+
+Run it on a host where the patched oslo.messaging and tomograph are
+installed::
+
+    python tools/rpc_benchmark.py --messages 20000 --endpoints 10 \\
+        --arg-size 1024 --serializer json --tracing off \\
+        --save-baseline rpc-baseline.json
+
+    # after changing client.py or dispatcher.py
+    python tools/rpc_benchmark.py ... --baseline rpc-baseline.json
+
+Compared against a baseline, the run fails with exit status 1 if the mean or
+p99 latency of any mode got worse by more than --threshold percent.
+"""
+
+from __future__ import print_function
+
+import argparse
+import gc
+import sys
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from oslo_config import cfg
+import oslo_messaging
+from oslo_messaging.rpc import dispatcher as rpc_dispatcher
+from oslo_serialization import jsonutils
+import tomograph
+
+import benchmark_common
+
+
+class _JsonSerializer(oslo_messaging.NoOpSerializer):
+    """Round-trips every entity through JSON, like a real serializer."""
+
+    def serialize_entity(self, ctxt, entity):
+        return jsonutils.loads(jsonutils.dumps(entity))
+
+    def deserialize_entity(self, ctxt, entity):
+        return jsonutils.loads(jsonutils.dumps(entity))
+
+
+_SERIALIZERS = {
+    'noop': oslo_messaging.NoOpSerializer,
+    'json': _JsonSerializer,
+}
+
+
+def _disable_tracing():
+    """Replace the tomograph hooks used by the RPC path with no-ops."""
+    trace_info = (None, None)
+    tomograph.start = lambda *args, **kwargs: None
+    tomograph.stop = lambda *args, **kwargs: None
+    tomograph.getHost = lambda: None
+    tomograph.get_trace_info = lambda: trace_info
+
+
+def _make_endpoints(count):
+    """Build count endpoints with distinct classes; the last one echoes."""
+    endpoints = []
+    for i in range(count):
+        cls = type('Endpoint%d' % i, (object,),
+                   {'method%d' % i: lambda self, ctxt, arg: None})
+        endpoints.append(cls())
+    # NOTE: the dispatcher scans endpoints in order, so putting the
+    # benchmarked method on the last one measures the worst case.
+    endpoints[-1].echo = lambda ctxt, arg: arg
+    return endpoints
+
+
+class _Poller(object):
+    """Feed incoming messages to the dispatcher like a blocking executor."""
+
+    def __init__(self, transport, dispatcher):
+        self._listener = dispatcher._listen(transport)
+        self._dispatcher = dispatcher
+        self._running = True
+        self.handled = 0
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+
+    def _run(self):
+        while self._running:
+            incoming = self._listener.poll(timeout=0.1)
+            if incoming is None:
+                continue
+            callback = self._dispatcher(incoming)
+            callback.run()
+            callback.done()
+            self.handled += 1
+
+
+def _send_all(client, poller, mode, messages, payload, samples=None):
+    ctxt = {'user': 'bench', 'project': 'bench'}
+    send = getattr(client, mode)
+    handled_before = poller.handled
+    for _ in range(messages):
+        sent = time.time()
+        send(ctxt, 'echo', arg=payload)
+        if samples is not None:
+            samples.append(time.time() - sent)
+    if mode == 'cast':
+        # NOTE: casts return before dispatch, so wait for the server to catch
+        # up to include the dispatch cost in the total.
+        while poller.handled - handled_before < messages:
+            time.sleep(0.001)
+
+
+def _run_mode(client, poller, mode, messages, payload):
+    """Send messages with call or cast and return the measurements."""
+    samples = []
+    gc.collect()
+    start = time.time()
+    _send_all(client, poller, mode, messages, payload, samples)
+    elapsed = time.time() - start
+
+    result = {
+        'messages': messages,
+        'per_message_us': elapsed / messages * 1e6,
+        'mean_us': sum(samples) / len(samples) * 1e6,
+        'p50_us': benchmark_common.percentile(samples, 0.50) * 1e6,
+        'p99_us': benchmark_common.percentile(samples, 0.99) * 1e6,
+        'messages_per_second': messages / elapsed,
+        'peak_bytes_per_message': None,
+        'retained_bytes_per_message': None,
+    }
+
+    if tracemalloc:
+        # NOTE: tracing allocations slows everything down, so memory is
+        # measured in a separate, shorter pass.
+        count = min(messages, 1000)
+        gc.collect()
+        tracemalloc.start()
+        _send_all(client, poller, mode, count, payload)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result['peak_bytes_per_message'] = peak / float(count)
+        result['retained_bytes_per_message'] = current / float(count)
+    return result
+
+
+def run(args):
+    if args.tracing == 'off':
+        _disable_tracing()
+
+    conf = cfg.ConfigOpts()
+    conf([])
+    transport = oslo_messaging.get_transport(conf, 'fake:')
+    target = oslo_messaging.Target(topic='benchmark', server='bench-server')
+    serializer = _SERIALIZERS[args.serializer]()
+
+    dispatcher = rpc_dispatcher.RPCDispatcher(
+        target, _make_endpoints(args.endpoints), serializer)
+    poller = _Poller(transport, dispatcher)
+    poller.start()
+
+    client = oslo_messaging.RPCClient(transport, target,
+                                      serializer=serializer)
+    payload = 'x' * args.arg_size
+    results = {}
+    try:
+        for mode in args.modes:
+            if args.warmup:
+                _send_all(client, poller, mode, args.warmup, payload)
+            results[mode] = _run_mode(client, poller, mode, args.messages,
+                                      payload)
+    finally:
+        poller.stop()
+        transport.cleanup()
+
+    return {
+        'config': {
+            'endpoints': args.endpoints,
+            'arg_size': args.arg_size,
+            'serializer': args.serializer,
+            'tracing': args.tracing,
+            'python': sys.version.split()[0],
+        },
+        'results': results,
+    }
+
+
+def compare(report, baseline, threshold):
+    """Print the changes against a baseline and return the regressions."""
+    regressions = []
+    for mode, result in sorted(report['results'].items()):
+        previous = baseline['results'].get(mode)
+        if previous:
+            regressions.extend(benchmark_common.compare_metrics(
+                mode, result, previous, (('mean_us', 1), ('p99_us', 1)),
+                threshold))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--messages', type=benchmark_common.count(1),
+                        default=10000,
+                        help='Messages to send per mode.')
+    parser.add_argument('--warmup', type=benchmark_common.count(0),
+                        default=500,
+                        help='Messages to send before measuring.')
+    parser.add_argument('--endpoints', type=benchmark_common.count(1),
+                        default=5,
+                        help='Number of endpoints the dispatcher scans.')
+    parser.add_argument('--arg-size', type=benchmark_common.count(0),
+                        default=256,
+                        help='Size in bytes of the argument of each call.')
+    parser.add_argument('--serializer', choices=sorted(_SERIALIZERS),
+                        default='noop')
+    parser.add_argument('--tracing', choices=('on', 'off'), default='on')
+    parser.add_argument('--modes', nargs='+', choices=('call', 'cast'),
+                        default=['call', 'cast'])
+    benchmark_common.add_baseline_options(parser)
+    args = parser.parse_args(argv)
+
+    return benchmark_common.finish(run(args), args, compare)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
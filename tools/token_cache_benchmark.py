@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Measure the in-process token cache of auth_token under many threads.
+
+Each thread looks up random token hashes in the cache and stores the ones
+that miss, as AuthProtocol does, for a fixed time. The run is repeated for
+every combination of thread count and shard count, so a single locked cache
+can be compared with a sharded one.
+
+Under CPython only one thread runs Python code at a time, so the total
+throughput cannot grow with the number of cores whatever the locking. What
+sharding removes is threads queuing on one lock: it shows in the latency of
+single operations, and in the throughput once the interpreter lets threads
+run in parallel. Run it on a host where the patched keystonemiddleware is
+installed::
+
+    python tools/token_cache_benchmark.py --threads 1 8 32 64 \\
+        --shards 1 16 --save-baseline cache-baseline.json
+
+    # after changing the cache
+    python tools/token_cache_benchmark.py ... --baseline cache-baseline.json
+
+Compared against a baseline, the run fails with exit status 1 if the
+throughput of any combination dropped, or its p99 latency grew, by more
+than --threshold percent.
+"""
+
+from __future__ import print_function
+
+import argparse
+import hashlib
+import random
+import sys
+import threading
+import time
+
+import benchmark_common
+from keystonemiddleware.auth_token import _cache
+
+
+def _keys(count):
+    return [hashlib.md5(str(i).encode()).hexdigest() for i in range(count)]
+
+
+def _run_combination(args, keys, threads, shards):
+    """Hammer one cache from threads threads and return the measurements."""
+    cache = _cache.lru_cache(args.cache_size, shards)
+    # NOTE: fill the cache first so the hit ratio is steady from the start.
+    for key in keys[:args.cache_size]:
+        cache.set(key, key, args.ttl)
+
+    start = threading.Event()
+    stop = threading.Event()
+    counts = []
+    samples = []
+    lock = threading.Lock()
+
+    def worker(seed):
+        rng = random.Random(seed)
+        own = []
+        done = 0
+        start.wait()
+        while not stop.is_set():
+            key = rng.choice(keys)
+            started = time.time()
+            if cache.get(key) is None:
+                cache.set(key, key, args.ttl)
+            if done % args.sample_every == 0:
+                own.append(time.time() - started)
+            done += 1
+        with lock:
+            counts.append(done)
+            samples.extend(own)
+
+    workers = [threading.Thread(target=worker, args=(i,))
+               for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    start.set()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in workers:
+        thread.join()
+
+    operations = sum(counts)
+    return {
+        'threads': threads,
+        'shards': shards,
+        'operations_per_second': operations / args.duration,
+        'p50_us': benchmark_common.percentile(samples, 0.50) * 1e6,
+        'p99_us': benchmark_common.percentile(samples, 0.99) * 1e6,
+    }
+
+
+def run(args):
+    if hasattr(sys, 'setswitchinterval'):
+        sys.setswitchinterval(args.switch_interval)
+
+    # NOTE: with keys drawn uniformly, the hit ratio is the share of the
+    # keys the cache can hold.
+    keys = _keys(int(args.cache_size / args.hit_ratio))
+    results = {}
+    for shards in args.shards:
+        for threads in args.threads:
+            results['%d threads, %d shards' % (threads, shards)] = (
+                _run_combination(args, keys, threads, shards))
+
+    return {
+        'config': {
+            'cache_size': args.cache_size,
+            'hit_ratio': args.hit_ratio,
+            'duration': args.duration,
+            'switch_interval': args.switch_interval,
+            'python': sys.version.split()[0],
+        },
+        'results': results,
+    }
+
+
+def compare(report, baseline, threshold):
+    """Print the changes against a baseline and return the regressions."""
+    regressions = []
+    for name, result in sorted(report['results'].items()):
+        previous = baseline['results'].get(name)
+        if previous:
+            # NOTE: a drop in throughput is as bad as a rise in latency
+            regressions.extend(benchmark_common.compare_metrics(
+                name, result, previous,
+                (('operations_per_second', -1), ('p99_us', 1)), threshold))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--threads', nargs='+',
+                        type=benchmark_common.count(1),
+                        default=[1, 8, 32, 64],
+                        help='Numbers of threads to run with.')
+    parser.add_argument('--shards', nargs='+',
+                        type=benchmark_common.count(1), default=[1, 16],
+                        help='Numbers of cache shards to run with.')
+    parser.add_argument('--cache-size', type=benchmark_common.count(1),
+                        default=10000, help='Entries the cache holds.')
+    parser.add_argument('--hit-ratio', type=benchmark_common.fraction,
+                        default=0.9,
+                        help='Fraction of lookups that find their entry.')
+    parser.add_argument('--ttl', type=float, default=300,
+                        help='Seconds entries are cached for.')
+    parser.add_argument('--duration', type=float, default=3.0,
+                        help='Seconds to run each combination for.')
+    parser.add_argument('--sample-every', type=benchmark_common.count(1),
+                        default=10, help='Time one operation in this many.')
+    parser.add_argument('--switch-interval', type=float, default=0.005,
+                        help='Seconds between interpreter thread switches, '
+                             'as in sys.setswitchinterval.')
+    benchmark_common.add_baseline_options(parser)
+    args = parser.parse_args(argv)
+    if args.hit_ratio == 0:
+        parser.error('argument --hit-ratio: must be above 0')
+    if args.duration <= 0:
+        parser.error('argument --duration: must be above 0')
+
+    return benchmark_common.finish(run(args), args, compare)
+
+
+if __name__ == '__main__':
+    sys.exit(main())